@@ -17,6 +17,13 @@
     #    for column in columns: # apply function foreach column
     #        df = df.<custom logic>
     #    return df #always return dataframe.
+    #register_cleansing_function("<functienaam>", <functienaam>)
+
+    # Vectorized functions get a pandas Series per column and run as pandas UDFs
+
+    #def <functienaam> (series, args):
+    #    return series.<custom logic> # return a Series of the same length
+    #register_vectorized_cleansing_function("<functienaam>", <functienaam>)
 
 # METADATA ********************
 
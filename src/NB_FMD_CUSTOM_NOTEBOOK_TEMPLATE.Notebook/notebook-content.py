@@ -92,6 +92,7 @@ driver = '{ODBC Driver 18 for SQL Server}'
 connstring=config_settings.fmd_fabric_db_connection
 database=config_settings.fmd_fabric_db_name
 schema_enabled =default_settings.lakehouse_schema_enabled
+AsyncAuditLogging = False
 result_data=''
 
 # METADATA ********************
@@ -150,7 +151,10 @@ audit_params = {
 
 # CELL ********************
 
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
+start_stage("Logging")
+if str(AsyncAuditLogging).lower() == "true":
+    enable_async_audit_logging(driver, connstring, database)
+execute_audit_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
 
 # METADATA ********************
 
@@ -180,6 +184,7 @@ spark.conf.set("spark.sql.parquet.datetimeRebaseModeInWrite", "CORRECTED")
 
 # CELL ********************
 
+start_stage("Custom")
 ## ====================== ##
 ## Start Custom code here ##
 ## ====================== ##
@@ -238,6 +243,7 @@ if output_dataframe is None or not isinstance(output_dataframe, DataFrame):
     raise Exception("No output_dataframe defined, or output_dataframe not a spark dataframe.")
 
 # Write the output dataframe to Onelake
+start_stage("Write")
 path = f"abfss://{WorkspaceGuid}@onelake.dfs.fabric.microsoft.com/{TargetLakehouseGuid}/Files/{TargetFilePath}/{TargetFileName}"
 print(f"Target path: {path}")
 output_dataframe.write.mode('overwrite').parquet(path)
@@ -268,14 +274,15 @@ result_data = {
         "LandingzoneEntityId" : EntityId,
         "StartTime" : start_audit_time,
         "EndTime" : end_audit_time
-    }
+    },
+    "Instrumentation": get_instrumentation()
 }
 
 # Write the logging entry into the logging database
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
+queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
 
 # Exit the notebook
-notebookutils.notebook.exit(result_data)
+exit_notebook(result_data)
 
 # METADATA ********************
 
@@ -50,6 +50,46 @@
 # register_cleansing_function("my_custom_function", my_custom_function)
 # ```
 # 
+# A function that only rewrites the value of each column can be registered as an expression instead. Expression rules are
+# compiled together into a single select, which keeps the Spark plan small on wide tables. The builder receives the column
+# name, its current expression and data type, and returns the new expression and data type (or None to fall back to the
+# DataFrame function registered under the same name):
+# ```
+# def my_custom_expression(column, expr, dtype, args):
+#     return upper(expr), dtype
+# register_cleansing_expression("my_custom_function", my_custom_expression)
+# ```
+# 
+# Logic that needs Python can be written as a vectorized function. It receives each column as a pandas Series (and the
+# rule parameters when it accepts a second argument) and returns a Series of the same length. It runs as an Arrow-backed
+# pandas UDF, a batch at a time instead of row by row, and is fused with the other expression rules:
+# ```
+# def my_vectorized_function(series, args):
+#     return series.str.replace(args['old'], args['new'])
+# register_vectorized_cleansing_function("my_vectorized_function", my_vectorized_function)
+# ```
+# Pass return_type (a DataType or DDL string) when the result type differs from the column type.
+# 
+# ## Data quality checks
+# Data quality rules use the same JSON layout, with "check" instead of "function", an optional "severity"
+# ("error" fails the load, "warn" only reports) and an optional "max_failed_ratio" parameter (default 0):
+# ```
+# [
+#    {"check": "not_null", "columns": "CustomerID;OrderDate", "severity": "error"},
+#    {"check": "domain", "columns": "Status", "parameters": {"values": ["Open", "Closed"]}, "severity": "warn"},
+#    {"check": "regex", "columns": "Email", "parameters": {"pattern": "^[^@]+@[^@]+$", "max_failed_ratio": 0.01}},
+#    {"check": "range", "columns": "Quantity", "parameters": {"min": 0, "max": 10000}},
+#    {"check": "referential", "columns": "CountryCode", "parameters": {"table": "<abfss path of a Delta table>", "column": "Code"}}
+# ]
+# ```
+# All checks are evaluated in one aggregate over the DataFrame. Custom checks return a boolean Column that is true
+# for rows that fail:
+# ```
+# def my_custom_check(column, args):
+#     return col(column) < lit(args['minimum'])
+# register_dq_check("my_custom_check", my_custom_check)
+# ```
+# 
 
 
 # CELL ********************
@@ -81,6 +121,87 @@ def register_cleansing_function(name, func, overwrite=False):
 
     _CLEANSING_FUNCTION_REGISTRY[normalized_name] = func
 
+# Registry of column expression builders, compiled into one select by handle_cleansing_functions().
+# A builder takes (column, expr, dtype, args) and returns (expr, dtype), or None when the rule
+# cannot be expressed per column and the DataFrame function of the same name must run instead.
+_CLEANSING_EXPRESSION_REGISTRY = {}
+
+def register_cleansing_expression(name, builder, overwrite=False):
+    """Register a column expression builder by name so rules using it can be fused into one projection."""
+    if not isinstance(name, str):
+        raise TypeError("Cleansing expression name must be a string.")
+
+    normalized_name = name.strip()
+    if not normalized_name:
+        raise ValueError("Cleansing expression name must be a non-empty string.")
+
+    if not callable(builder):
+        raise TypeError(
+            f"Cleansing expression '{normalized_name}' must be callable."
+        )
+
+    if not overwrite and normalized_name in _CLEANSING_EXPRESSION_REGISTRY:
+        raise ValueError(
+            f"Cleansing expression '{normalized_name}' is already registered. "
+            "Pass overwrite=True to replace the existing registration."
+        )
+
+    _CLEANSING_EXPRESSION_REGISTRY[normalized_name] = builder
+
+# Registry of data quality checks. A check takes (column, args) and returns a boolean
+# Column that is true for the rows failing the check.
+_DQ_CHECK_REGISTRY = {}
+
+def register_dq_check(name, builder, overwrite=False):
+    """Register a data quality check by name so it can be invoked from DQ rules."""
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("DQ check name must be a non-empty string.")
+    normalized_name = name.strip()
+
+    if not callable(builder):
+        raise TypeError(f"DQ check '{normalized_name}' must be callable.")
+
+    if not overwrite and normalized_name in _DQ_CHECK_REGISTRY:
+        raise ValueError(
+            f"DQ check '{normalized_name}' is already registered. "
+            "Pass overwrite=True to replace the existing registration."
+        )
+
+    _DQ_CHECK_REGISTRY[normalized_name] = builder
+
+def register_vectorized_cleansing_function(name, func, return_type=None, overwrite=False):
+    """Register a pd.Series -> pd.Series function as a pandas UDF cleansing rule.
+
+    It is registered as an expression (fused into the cleansing select) and, for callers of
+    dynamic_call_cleansing_function, as a regular (df, columns, args) function.
+    """
+    from inspect import signature
+    import pandas as pd
+    from pyspark.sql.functions import pandas_udf
+    from pyspark.sql.types import StringType, _parse_datatype_string
+
+    if not callable(func):
+        raise TypeError(f"Cleansing function '{name}' must be callable.")
+    # Later rules on the column read its type as a DataType, so a DDL string is parsed once here
+    if isinstance(return_type, str):
+        return_type = _parse_datatype_string(return_type)
+    takes_args = len(signature(func).parameters) > 1
+
+    def builder(column, expr, dtype, args):
+        result_type = return_type or dtype or StringType()
+
+        @pandas_udf(result_type)
+        def vectorized(series: pd.Series) -> pd.Series:
+            return func(series, args) if takes_args else func(series)
+
+        return vectorized(expr), result_type
+
+    def dataframe_function(df, columns, args):
+        return apply_cleansing_expression(df, builder, columns, args)
+
+    register_cleansing_expression(name, builder, overwrite=overwrite)
+    register_cleansing_function(name, dataframe_function, overwrite=overwrite)
+
 # METADATA ********************
 
 # META {
@@ -163,23 +284,22 @@ def normalize_cleansing_rules(cleansing_rules):
 
     return cleansing_rules
 
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# CELL ********************
+class CompiledCleansingRules(list):
+    """Rules returned by compile_cleansing_rules; compiling them again returns them unchanged."""
 
-def handle_cleansing_functions(df: DataFrame, cleansing_rules):
-    cleansing_rules = normalize_cleansing_rules(cleansing_rules)
 
-    for rule in cleansing_rules:
+def compile_cleansing_rules(cleansing_rules):
+    """Normalize and validate rules into a list of {"function", "columns": [...], "parameters": {...}}."""
+    if isinstance(cleansing_rules, CompiledCleansingRules):
+        return cleansing_rules
+    compiled = CompiledCleansingRules()
+    for rule in normalize_cleansing_rules(cleansing_rules):
         function = rule.get("function")
         if not function:
             print(f"'function' missing in: {rule}")
             continue
+        if function not in _CLEANSING_FUNCTION_REGISTRY and function not in _CLEANSING_EXPRESSION_REGISTRY:
+            raise ValueError(f"Function '{function}' is not a registered cleansing function.")
 
         parameters = rule.get("parameters")
         if parameters is None:
@@ -188,12 +308,152 @@ def handle_cleansing_functions(df: DataFrame, cleansing_rules):
             raise TypeError(
                 f"'parameters' must be a dict for function '{function}' (got {type(parameters).__name__})"
             )
+
         columns_raw = rule.get("columns")
+        if isinstance(columns_raw, list):
+            columns = columns_raw
+        else:
+            columns = (
+                [c.strip() for c in columns_raw.split(";") if c.strip()]
+                if columns_raw else []
+            )
+        compiled.append({"function": function, "columns": columns, "parameters": parameters})
+    return compiled
 
-        columns = (
-            [c.strip() for c in columns_raw.split(";") if c.strip()]
-            if columns_raw else []
-        )
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Cache of compiled cleansing rules per (layer, entity id).
+# Entries live in the session and as JSON in the lakehouse Files area
+# (Files/_fmd_cleansing_rule_cache/<layer>_<entity id>.json), so the notebooks of one pipeline
+# run share them. An entry is valid for the pipeline run (version) that fetched it and at most
+# CLEANSING_RULE_CACHE_TTL_SECONDS; the ETag (hash of the compiled rules) avoids rewriting
+# the file when a new run fetches the same rules.
+import hashlib
+import json
+import time
+
+CLEANSING_RULE_CACHE_FOLDER = "_fmd_cleansing_rule_cache"
+CLEANSING_RULE_CACHE_TTL_SECONDS = 3600
+CLEANSING_RULE_CACHE_MAX_BYTES = 10 * 1024 * 1024
+
+if "_CLEANSING_RULE_CACHE" not in globals():
+    _CLEANSING_RULE_CACHE = {}
+
+
+def cleansing_rule_cache_path(workspace, lakehouse, layer, entity_id):
+    return f"abfss://{workspace}@onelake.dfs.fabric.microsoft.com/{lakehouse}/Files/{CLEANSING_RULE_CACHE_FOLDER}/{layer}_{entity_id}.json"
+
+
+def _cleansing_rule_cache_valid(entry, version, ttl_seconds):
+    if entry is None or entry.get("Version") != version:
+        return False
+    return time.time() - entry.get("CachedAt", 0) < ttl_seconds
+
+
+def _read_cleansing_rule_cache(path):
+    try:
+        if notebookutils.fs.exists(path):
+            return json.loads(notebookutils.fs.head(path, CLEANSING_RULE_CACHE_MAX_BYTES))
+    except Exception as e:
+        print(f"Cleansing rule cache {path} unreadable: {e}")
+    return None
+
+
+def get_cleansing_rules(layer, entity_id, fetch_rules, cache_path=None, version=None, ttl_seconds=CLEANSING_RULE_CACHE_TTL_SECONDS):
+    """Return the compiled rules of an entity, or None when it has none configured.
+
+    fetch_rules is called without arguments on a cache miss and returns the rules JSON text (or None).
+    """
+    key = (layer, str(entity_id))
+    entry = _CLEANSING_RULE_CACHE.get(key)
+    if _cleansing_rule_cache_valid(entry, version, ttl_seconds):
+        return entry["Rules"]
+
+    stored = _read_cleansing_rule_cache(cache_path) if cache_path else None
+    if _cleansing_rule_cache_valid(stored, version, ttl_seconds):
+        # The file holds rules compiled by an earlier notebook of the run
+        if stored["Rules"] is not None:
+            stored["Rules"] = CompiledCleansingRules(stored["Rules"])
+        _CLEANSING_RULE_CACHE[key] = stored
+        return stored["Rules"]
+
+    rules_str = fetch_rules()
+    rules = compile_cleansing_rules(rules_str) if rules_str is not None else None
+    etag = hashlib.sha256(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+    entry = {
+        "Layer": layer,
+        "EntityId": str(entity_id),
+        "Etag": etag,
+        "Version": version,
+        "CachedAt": time.time(),
+        "Rules": rules
+    }
+    _CLEANSING_RULE_CACHE[key] = entry
+    if cache_path:
+        try:
+            if stored is None or stored.get("Etag") != etag or stored.get("Version") != version:
+                notebookutils.fs.put(cache_path, json.dumps(entry), True)
+        except Exception as e:
+            print(f"Cleansing rule cache {cache_path} not written: {e}")
+    return rules
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+def build_cleansing_expressions(func_name, columns, args, pending, dtypes):
+    """Return the pending column expressions with the rule applied, or None if it needs the DataFrame function."""
+    builder = _CLEANSING_EXPRESSION_REGISTRY.get(func_name)
+    if builder is None:
+        return None
+
+    updated = dict(pending)
+    for column in columns:
+        column = dtypes.get(column.lower(), (column, None))[0]
+        current_expr, current_dtype = updated.get(column, (col(column), dtypes.get(column.lower(), (column, None))[1]))
+        try:
+            result = builder(column, current_expr, current_dtype, args)
+        except Exception as e:
+            raise ValueError(f"Function '{func_name}' failed with Error: {e}") from e
+        if result is None:
+            return None
+        updated[column] = result
+    return updated
+
+def _flush_cleansing_expressions(df: DataFrame, pending):
+    """Apply all pending column expressions in a single select."""
+    if not pending:
+        return df
+    # The select is built from the DataFrame's columns, so a rule on a missing column would be dropped silently
+    unknown = [c for c in pending if c not in df.columns]
+    if unknown:
+        raise ValueError(f"Cleansing rules refer to column(s) that do not exist in the source: {', '.join(unknown)}")
+    return df.select(*[pending[c][0].alias(c) if c in pending else col(c) for c in df.columns])
+
+def handle_cleansing_functions(df: DataFrame, cleansing_rules):
+    # Rules from get_cleansing_rules are compiled already and used as they are
+    cleansing_rules = compile_cleansing_rules(cleansing_rules)
+
+    # Column expressions not yet applied, per column name: (expr, dtype)
+    pending = {}
+    dtypes = {f.name.lower(): (f.name, f.dataType) for f in df.schema.fields}
+
+    for rule in cleansing_rules:
+        function = rule["function"]
+        parameters = rule["parameters"]
+        columns = rule["columns"]
 
         print(
             f"\nFunction: {function}"
@@ -201,14 +461,23 @@ def handle_cleansing_functions(df: DataFrame, cleansing_rules):
             f"\nColumns: {columns}"
         )
 
+        compiled = build_cleansing_expressions(function, columns, parameters, pending, dtypes)
+        if compiled is not None:
+            pending = compiled
+            continue
+
+        # DataFrame functions see the result of all earlier rules
+        df = _flush_cleansing_expressions(df, pending)
+        pending = {}
         df = dynamic_call_cleansing_function(
             df,
             function,
             columns,
             parameters
         )
+        dtypes = {f.name.lower(): (f.name, f.dataType) for f in df.schema.fields}
 
-    return df
+    return _flush_cleansing_expressions(df, pending)
 
 # METADATA ********************
 
@@ -225,8 +494,21 @@ def handle_cleansing_functions(df: DataFrame, cleansing_rules):
 
 # CELL ********************
 
-from pyspark.sql.functions import col, trim, regexp_replace, lower, upper, initcap, when, length, lit, coalesce,to_date, to_timestamp, when
+from pyspark.sql.functions import col, trim, regexp_replace, lower, upper, initcap, when, length, lit, coalesce,to_date, to_timestamp, when, count
+from pyspark.sql.functions import sum as spark_sum
 from pyspark.sql import DataFrame
+from pyspark.sql.types import StringType, DateType, TimestampType
+
+def apply_cleansing_expression(df: DataFrame, builder, columns, args):
+    """Apply an expression builder to the given columns as a DataFrame function, in one select."""
+    dtypes = {f.name.lower(): (f.name, f.dataType) for f in df.schema.fields}
+    pending = {}
+    for column in columns:
+        column = dtypes.get(column.lower(), (column, None))[0]
+        result = builder(column, col(column), dtypes.get(column.lower(), (column, None))[1], args)
+        if result is not None:
+            pending[column] = result
+    return _flush_cleansing_expressions(df, pending)
 
 # METADATA ********************
 
@@ -237,7 +519,7 @@ from pyspark.sql import DataFrame
 
 # CELL ********************
 
-def normalize_text(df: DataFrame, columns, args):
+def normalize_text_expression(column, current, dtype, args):
     """
     Args (all optional in args dict):
       - case: one of {'lower','upper','title', None}  (default: None)
@@ -248,23 +530,25 @@ def normalize_text(df: DataFrame, columns, args):
     collapse_spaces = args.get('collapse_spaces', True)
     empty_as_null = args.get('empty_as_null', True)
 
-    for c in columns:
-        expr = trim(col(c))
-        if collapse_spaces:
-            # Replace 2+ spaces with a single space
-            expr = regexp_replace(expr, r"\s{2,}", " ")
-        if case == 'lower':
-            expr = lower(expr)
-        elif case == 'upper':
-            expr = upper(expr)
-        elif case == 'title':
-            expr = initcap(expr)
-
-        if empty_as_null:
-            expr = when(length(expr) == 0, lit(None)).otherwise(expr)
-
-        df = df.withColumn(c, expr)
-    return df
+    expr = trim(current)
+    if collapse_spaces:
+        # Replace 2+ spaces with a single space
+        expr = regexp_replace(expr, r"\s{2,}", " ")
+    if case == 'lower':
+        expr = lower(expr)
+    elif case == 'upper':
+        expr = upper(expr)
+    elif case == 'title':
+        expr = initcap(expr)
+
+    if empty_as_null:
+        expr = when(length(expr) == 0, lit(None)).otherwise(expr)
+
+    return expr, StringType()
+
+def normalize_text(df: DataFrame, columns, args):
+    """DataFrame form of normalize_text_expression."""
+    return apply_cleansing_expression(df, normalize_text_expression, columns, args)
 
 # METADATA ********************
 
@@ -275,7 +559,7 @@ def normalize_text(df: DataFrame, columns, args):
 
 # CELL ********************
 
-def fill_nulls(df: DataFrame, columns, args):
+def fill_nulls_expression(column, current, dtype, args):
     """
     Args:
       - defaults: dict[str, any]   -> per-column default values
@@ -288,22 +572,22 @@ def fill_nulls(df: DataFrame, columns, args):
     default_numeric = args.get('default_numeric', None)
     default_date = args.get('default_date', None)
 
-    for c in columns:
-        if c in defaults:
-            df = df.withColumn(c, coalesce(col(c), lit(defaults[c])))
-        else:
-            dtype = [f.dataType for f in df.schema.fields if f.name == c]
-            dtype = dtype[0] if dtype else None
-            if dtype is None:
-                continue
-
-            if default_string is not None and dtype.simpleString().startswith('string'):
-                df = df.withColumn(c, coalesce(col(c), lit(default_string)))
-            elif default_numeric is not None and dtype.simpleString() in ('int', 'bigint', 'double', 'float', 'decimal'):
-                df = df.withColumn(c, coalesce(col(c), lit(default_numeric)))
-            elif default_date is not None and dtype.simpleString() in ('date',):
-                df = df.withColumn(c, coalesce(col(c), lit(default_date)))
-    return df
+    if column in defaults:
+        return coalesce(current, lit(defaults[column])), dtype
+    if dtype is None:
+        return current, dtype
+
+    if default_string is not None and dtype.simpleString().startswith('string'):
+        return coalesce(current, lit(default_string)), dtype
+    elif default_numeric is not None and dtype.simpleString() in ('int', 'bigint', 'double', 'float', 'decimal'):
+        return coalesce(current, lit(default_numeric)), dtype
+    elif default_date is not None and dtype.simpleString() in ('date',):
+        return coalesce(current, lit(default_date)), dtype
+    return current, dtype
+
+def fill_nulls(df: DataFrame, columns, args):
+    """DataFrame form of fill_nulls_expression."""
+    return apply_cleansing_expression(df, fill_nulls_expression, columns, args)
 
 # METADATA ********************
 
@@ -339,6 +623,20 @@ def parse_datetime(df: DataFrame, columns, args):
             df = df.drop(c)
     return df
 
+def parse_datetime_expression(column, current, dtype, args):
+    """In-place form of parse_datetime; rules writing 'into' another column use the DataFrame function."""
+    if args.get('into', None):
+        return None
+
+    target_type = args.get('target_type', 'date')
+    formats = args.get('formats', ['yyyy-MM-dd'])
+
+    parsed = None
+    for fmt in formats:
+        candidate = to_timestamp(current, fmt) if target_type == 'timestamp' else to_date(current, fmt)
+        parsed = candidate if parsed is None else coalesce(parsed, candidate)
+    return parsed, TimestampType() if target_type == 'timestamp' else DateType()
+
 # METADATA ********************
 
 # META {
@@ -353,6 +651,155 @@ register_cleansing_function("normalize_text", normalize_text)
 register_cleansing_function("fill_nulls", fill_nulls)
 register_cleansing_function("parse_datetime", parse_datetime)
 
+register_cleansing_expression("normalize_text", normalize_text_expression)
+register_cleansing_expression("fill_nulls", fill_nulls_expression)
+register_cleansing_expression("parse_datetime", parse_datetime_expression)
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# # Data quality checks
+# 
+
+# CELL ********************
+
+DQ_SEVERITIES = ('error', 'warn')
+
+class DQLookup:
+    """Result of a check that looks values up in a reference DataFrame: rows whose non-null value has no match fail.
+    evaluate_dq_rules left-joins the distinct reference values, so the lookup is part of its single aggregate."""
+    def __init__(self, reference: DataFrame, reference_column):
+        self.reference = reference
+        self.reference_column = reference_column
+
+def dq_not_null(column, args):
+    return col(column).isNull()
+
+def dq_domain(column, args):
+    return col(column).isNotNull() & ~col(column).isin(list(args['values']))
+
+def dq_regex(column, args):
+    return col(column).isNotNull() & ~col(column).cast('string').rlike(args['pattern'])
+
+def dq_range(column, args):
+    failed = lit(False)
+    if args.get('min') is not None:
+        failed = failed | (col(column) < lit(args['min']))
+    if args.get('max') is not None:
+        failed = failed | (col(column) > lit(args['max']))
+    return col(column).isNotNull() & failed
+
+def dq_referential(column, args):
+    """Values must exist in args['values'] or in args['column'] of the Delta table at args['table']."""
+    if args.get('values') is not None:
+        return col(column).isNotNull() & ~col(column).isin(list(args['values']))
+    return DQLookup(spark.read.format('delta').load(args['table']), args['column'])
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+def compile_dq_rules(dq_rules):
+    """Normalize and validate DQ rules into a list of {"check", "columns", "parameters", "severity"}."""
+    compiled = []
+    for rule in normalize_cleansing_rules(dq_rules):
+        check = rule.get("check")
+        if check not in _DQ_CHECK_REGISTRY:
+            available = ", ".join(sorted(_DQ_CHECK_REGISTRY.keys()))
+            raise ValueError(f"Check '{check}' is not a registered DQ check. Available checks: {available}")
+
+        parameters = rule.get("parameters") or {}
+        if not isinstance(parameters, dict):
+            raise TypeError(f"'parameters' must be a dict for check '{check}' (got {type(parameters).__name__})")
+
+        severity = str(rule.get("severity", "error")).lower()
+        if severity not in DQ_SEVERITIES:
+            raise ValueError(f"Severity of check '{check}' must be one of {DQ_SEVERITIES}, got '{severity}'")
+
+        columns_raw = rule.get("columns")
+        columns = columns_raw if isinstance(columns_raw, list) else [c.strip() for c in (columns_raw or "").split(";") if c.strip()]
+        if not columns:
+            raise ValueError(f"Check '{check}' has no columns: {rule}")
+        compiled.append({"check": check, "columns": columns, "parameters": parameters, "severity": severity})
+    return compiled
+
+def evaluate_dq_rules(df: DataFrame, dq_rules):
+    """Evaluate all DQ rules in one aggregate and return one result per (check, column)."""
+    rules = compile_dq_rules(dq_rules)
+    if not rules:
+        return []
+
+    metrics = [count(lit(1)).alias("_dq_total")]
+    results = []
+    for rule in rules:
+        for column in rule["columns"]:
+            try:
+                failed = _DQ_CHECK_REGISTRY[rule["check"]](column, rule["parameters"])
+            except Exception as e:
+                raise ValueError(f"Check '{rule['check']}' on '{column}' failed with Error: {e}") from e
+            if isinstance(failed, DQLookup):
+                # Distinct reference values keep the row count; Spark broadcasts a small reference set
+                key, found = f"_dq_key_{len(results)}", f"_dq_found_{len(results)}"
+                reference = (failed.reference
+                             .select(col(failed.reference_column).alias(key))
+                             .distinct()
+                             .withColumn(found, lit(True)))
+                df = df.join(reference, col(column) == col(key), "left")
+                failed = col(column).isNotNull() & col(found).isNull()
+            metrics.append(spark_sum(when(failed, 1).otherwise(0)).alias(f"_dq_{len(results)}"))
+            results.append({
+                "Check": rule["check"],
+                "Column": column,
+                "Severity": rule["severity"],
+                "MaxFailedRatio": float(rule["parameters"].get("max_failed_ratio", 0))
+            })
+
+    row = df.agg(*metrics).collect()[0]
+    total = row["_dq_total"] or 0
+    for i, result in enumerate(results):
+        failed = row[f"_dq_{i}"] or 0
+        result["Failed"] = failed
+        result["Total"] = total
+        result["FailedRatio"] = failed / total if total else 0.0
+        result["Passed"] = result["FailedRatio"] <= result["MaxFailedRatio"]
+    return results
+
+def dq_failures(results, severity="error"):
+    """Return the failed results of the given severity."""
+    return [r for r in results if not r["Passed"] and r["Severity"] == severity]
+
+def dq_summary(results):
+    """Return the counts of the results and the failed ones only, for result_data["DataQuality"]."""
+    failed = [r for r in results if not r["Passed"]]
+    return {"Total": len(results), "Passed": len(results) - len(failed), "Failed": len(failed), "FailedRules": failed}
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Register built-in DQ checks
+register_dq_check("not_null", dq_not_null)
+register_dq_check("domain", dq_domain)
+register_dq_check("regex", dq_regex)
+register_dq_check("range", dq_range)
+register_dq_check("referential", dq_referential)
+
 # METADATA ********************
 
 # META {
@@ -22,7 +22,7 @@
 # - **Soft Deletes**: Marks deleted records with IsDeleted flag while preserving history
 # - **Temporal Tracking**: Maintains RecordStartDate, RecordEndDate, RecordModifiedDate, and IsCurrent flags
 # - **V-Order Optimization**: Enables V-Order for improved query performance on Silver tables
-# - **Change Data Feed**: Enables CDC capabilities for downstream consumers
+# - **Change Data Feed**: Enables CDC capabilities for downstream consumers; with UseChangeDataFeed only the Bronze changes since the last processed Bronze version are read
 # - **Audit Logging**: Tracks execution details in the framework database
 # 
 # ## SCD Type 2 Operations
@@ -35,7 +35,7 @@
 # 2. Apply cleansing rules from framework configuration
 # 3. Calculate hash columns for change detection
 # 4. Add SCD Type 2 tracking columns
-# 5. Identify changes (inserts, updates, deletes) by comparing with existing Silver data
+# 5. Identify changes (inserts, updates, deletes) with a single full outer join against the current Silver rows
 # 6. Execute Delta merge operation applying SCD Type 2 logic
 # 7. Optimize and vacuum Delta table
 # 8. Update processing status and complete audit logging
@@ -81,6 +81,9 @@ connstring=config_settings.fmd_fabric_db_connection
 database=config_settings.fmd_fabric_db_name
 schema_enabled =default_settings.lakehouse_schema_enabled
 EntityLayer='Silver'
+AsyncAuditLogging = False
+# Read only the Bronze changes since the last processed Bronze version instead of the whole table
+UseChangeDataFeed = False
 result_data=''
 
 # METADATA ********************
@@ -100,7 +103,9 @@ import re
 from datetime import datetime, timezone
 import json
 from delta.tables import *
-from pyspark.sql.functions import sha2, md5, concat_ws, current_timestamp, expr
+from pyspark import StorageLevel
+from pyspark.sql import Window
+from pyspark.sql.functions import sha2, md5, concat_ws, current_timestamp, expr, col, lit, when, coalesce, array, explode, row_number
 from pyspark.sql.types import StringType
 
 
@@ -193,7 +198,10 @@ audit_params = {
 
 # CELL ********************
 
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
+start_stage("Logging")
+if str(AsyncAuditLogging).lower() == "true":
+    enable_async_audit_logging(driver, connstring, database)
+execute_audit_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
 
 # METADATA ********************
 
@@ -257,10 +265,70 @@ print(target_data_path)
 
 # CELL ********************
 
-#Read all incoming changes in Delta format
-dfDataChanged= spark.read\
-                .format("delta") \
-                .load(f"{source_changes_data_path}")
+start_stage("Read")
+SOURCE_VERSION_PROPERTY = "fmd.sourceBronzeVersion"
+
+source_table = DeltaTable.forPath(spark, source_changes_data_path)
+source_version = source_table.history(1).select("version").first()[0]
+target_exists = DeltaTable.isDeltaTable(spark, target_data_path)
+use_change_feed = str(UseChangeDataFeed).lower() == "true"
+changed_keys = None
+
+last_source_version = None
+if use_change_feed and target_exists:
+    target_properties = DeltaTable.forPath(spark, target_data_path).detail().first()["properties"]
+    last_source_version = target_properties.get(SOURCE_VERSION_PROPERTY)
+    if source_table.detail().first()["properties"].get("delta.enableChangeDataFeed", "false").lower() != "true":
+        # The feed starts at the version it is enabled in, so this run still reads the whole table
+        spark.sql(f"ALTER TABLE delta.`{source_changes_data_path}` SET TBLPROPERTIES ('delta.enableChangeDataFeed' = 'true')")
+        source_version = source_table.history(1).select("version").first()[0]
+        last_source_version = None
+
+if last_source_version is not None and int(last_source_version) > source_version:
+    # Bronze was recreated since the last run, its versions no longer line up
+    last_source_version = None
+
+if last_source_version is not None:
+    last_source_version = int(last_source_version)
+    try:
+        if last_source_version == source_version:
+            dfSourceChanges = spark.read.format("delta").option("versionAsOf", source_version).load(source_changes_data_path).limit(0) \
+                .withColumn("_change_type", lit("insert")).withColumn("_commit_version", lit(source_version).cast("long"))
+        else:
+            dfSourceChanges = (spark.read.format("delta")
+                               .option("readChangeFeed", "true")
+                               .option("startingVersion", last_source_version + 1)
+                               .option("endingVersion", source_version)
+                               .load(source_changes_data_path)
+                               .where(col("_change_type") != "update_preimage"))
+        # Keep the latest change per key; its type decides between upsert and delete
+        latest_change = Window.partitionBy("HashedPKColumn").orderBy(col("_commit_version").desc())
+        dfSourceChanges = (dfSourceChanges
+                           .withColumn("_change_rank", row_number().over(latest_change))
+                           .where(col("_change_rank") == 1)
+                           .drop("_change_rank", "_commit_timestamp")
+                           .persist(StorageLevel.MEMORY_AND_DISK))
+        change_count = dfSourceChanges.count()
+        record_metric("ChangedKeys", change_count)
+        changed_keys = dfSourceChanges.select("HashedPKColumn")
+        dfDataChanged = dfSourceChanges.where(col("_change_type") != "delete").drop("_change_type", "_commit_version")
+        print(f"Read {change_count} changed key(s) from Bronze versions {last_source_version + 1} to {source_version}")
+    except Exception as e:
+        # Versions older than the log retention are no longer readable as changes
+        print(f"Change data feed unavailable ({str(e)[:200]}), reading the whole Bronze table")
+        changed_keys = None
+
+if changed_keys is None:
+    #Read all incoming changes in Delta format
+    dfDataChanged= spark.read\
+                    .format("delta") \
+                    .option("versionAsOf", source_version) \
+                    .load(f"{source_changes_data_path}")
+
+record_metric("SourceBronzeVersion", source_version)
+
+# HashedPKBucket only describes the physical layout of a partitioned Bronze table
+dfDataChanged = dfDataChanged.drop("HashedPKBucket")
 
 # METADATA ********************
 
@@ -286,6 +354,7 @@ dfDataChanged= spark.read\
 
 # CELL ********************
 
+start_stage("Cleansing")
 if cleansing_rules == "":
     cleansing_rules = []
 
@@ -298,13 +367,7 @@ if cleansing_rules == "":
 
 # CELL ********************
 
-CleansingRules=execute_with_outputs(SP_GET_CLEANSING_RULE, driver, connstring, database, SilverLayerEntityId=SilverLayerEntityId)
-rules_str = None
-# Extract the string
-rules_str = CleansingRules["result_sets"][0][0]["CleansingRules"]
-if rules_str != None :
-# Convert JSON text → Python dict/list
-    cleansing_rules = json.loads(rules_str)
+%run NB_FMD_DQ_CLEANSING
 
 # METADATA ********************
 
@@ -315,7 +378,16 @@ if rules_str != None :
 
 # CELL ********************
 
-%run NB_FMD_DQ_CLEANSING
+def fetch_cleansing_rules():
+    CleansingRules=execute_with_outputs(SP_GET_CLEANSING_RULE, driver, connstring, database, SilverLayerEntityId=SilverLayerEntityId)
+    # Extract the string
+    return CleansingRules["result_sets"][0][0]["CleansingRules"]
+
+cached_rules = get_cleansing_rules("Silver", SilverLayerEntityId, fetch_cleansing_rules,
+                                   cache_path=cleansing_rule_cache_path(TargetWorkspace, TargetLakehouse, "Silver", SilverLayerEntityId),
+                                   version=PipelineRunGuid)
+if cached_rules is not None:
+    cleansing_rules = cached_rules
 
 # METADATA ********************
 
@@ -337,6 +409,7 @@ dfDataChanged=handle_cleansing_functions(dfDataChanged,cleansing_rules)
 
 # CELL ********************
 
+start_stage("Hash")
 non_key_columns = [column for column in dfDataChanged.columns if column not in ('HashedPKColumn','HashedNonKeyColumns')]
 
 #add a hashed cloumn to detect changes
@@ -370,8 +443,9 @@ dfDataChanged = dfDataChanged.withColumn('IsDeleted', lit(False).cast('boolean')
 
 # CELL ********************
 
+start_stage("Merge")
 #Check if Target exist, if exists read the original data if not create table and exit
-if DeltaTable.isDeltaTable(spark, target_data_path):
+if target_exists:
     # Read original/current data
     dfDataOriginal = (spark
                         .read.format("delta")
@@ -381,6 +455,9 @@ if DeltaTable.isDeltaTable(spark, target_data_path):
 else:
     # Use first load when no data exists yet and then exit 
     dfDataChanged.write.format("delta").mode("overwrite").save(target_data_path)
+    if use_change_feed:
+        spark.sql(f"ALTER TABLE delta.`{target_data_path}` SET TBLPROPERTIES ('{SOURCE_VERSION_PROPERTY}' = '{source_version}')")
+    record_metric("DeltaOperation", get_delta_operation_metrics(target_data_path, ("WRITE", "CREATE TABLE AS SELECT"), 5))
     end_audit_time = datetime.now()
     TotalRuntime = str((end_audit_time - start_audit_time)) 
 
@@ -391,38 +468,17 @@ else:
             "TargetSchema": TargetSchema,
             "TargetName" : TargetName,
             "EntityId" : SilverLayerEntityId,
-            "StartTime" : start_audit_time,
-            "EndTime" : end_audit_time
+            "StartTime" : str(start_audit_time),
+            "EndTime" : str(end_audit_time)
 
+        },
+        "Instrumentation": get_instrumentation()
         }
-        }
-
-    execute_with_outputs(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="True", BronzeLayerEntityId=BronzeLayerEntityId)
-    execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
-
-    notebookutils.notebook.exit(result_data)
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Add columns for Merge SCD 2
-# - ********************
-# - Add Action column for merge processing
-# - DataChanged = dfDataChanged.withColumn('HashedPKColumn', dfDataChanged['HashedPKColumn'])
-# - DataChanged = dfDataChanged.withColumn('Action', lit('U'))
-
-
-# CELL ********************
 
-columns_to_insert_deletes = {f"changes.{column}" for column in dfDataOriginal.columns if column not in ('HashedPKColumn', 'Action')}
-columns_original = {f"original.{column}" for column in dfDataOriginal.columns if column not in ('HashedPKColumn', 'Action')}
+    queue_sql_call(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="True", BronzeLayerEntityId=BronzeLayerEntityId)
+    queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
 
+    exit_notebook(result_data)
 
 # METADATA ********************
 
@@ -434,161 +490,62 @@ columns_original = {f"original.{column}" for column in dfDataOriginal.columns if
 # MARKDOWN ********************
 
 # ## Check for changes
+# - Only current Silver rows take part in change detection
+# - One full outer join on HashedPKColumn yields every action: each joined row explodes into an old-side action (U or D) and/or a new-side action (I)
 
 # CELL ********************
 
-# Define columns to insert and delete
-columns_to_insert_deletes = {f"changes.{column}" for column in dfDataOriginal.columns if column not in ('HashedPKColumn', 'Action')}
+SCD2_TRACKING_COLUMNS = ('HashedPKColumn', 'HashedNonKeyColumns', 'IsCurrent', 'RecordStartDate', 'RecordModifiedDate', 'RecordEndDate', 'IsDeleted', 'Action')
 
-#### Join DataFrames for deletes
-#
-# Here, we identify all of the records that are:
-#   1. NOT in the incoming changes, but IN the original
-#   2. IN the incoming changes, but DELETED in the original
-# 
-# Both require updates.
-#
-# For 1:
-#   This requires the original row to be set to IsDeleted=True
-#
-# For 2:
-#   This requires the original row to be set to IsCurrent=False
-#   These rows are accompanied by inserts, which will be identified seperately (in df_inserts) 
-####
-df_deletes = (
-    dfDataOriginal.alias('original')
-    .join(
-        dfDataChanged.alias('changes'),
-        (dfDataChanged.HashedPKColumn == dfDataOriginal.HashedPKColumn) &
-        (dfDataOriginal.IsDeleted.cast('boolean') == lit(False).cast('boolean')),
-        how='left'
-    )
-    .where("changes.HashedPKColumn is null")
-    .where("original.IsCurrent == true")
-    .select(
-        "original.HashedPKColumn",
-        "original.RecordStartDate",
-        "original.HashedNonKeyColumns",
-        lit('D').alias('Action'),
-        *columns_to_insert_deletes
-    )
-    .withColumn('RecordEndDate', current_timestamp())
-    .drop(col("changes.RecordStartDate"))
-    .drop(col("changes.HashedNonKeyColumns"))
-    .withColumn('IsCurrent', lit(False))
-    .withColumn('IsDeleted', lit(True))
-)
+dfDataCurrent = dfDataOriginal.where(col('IsCurrent') == True)
+if changed_keys is not None:
+    # Keys missing from the change set are untouched; deleted keys stay in the original side and become D
+    dfDataCurrent = dfDataCurrent.join(changed_keys, 'HashedPKColumn', 'left_semi')
 
-#### Process updated records (new rows)
-#
-# Here, we identify all of the records that are:
-#   - IN the incoming changes, AND IN the original, but
-#     with different content, i.e. different HashedNonKeyColumns
+#### Actions per key
 #
-# Here, we isolate the rows from the incoming changes (new) because we 
-# need to INSERT the new rows.
+# D: the current original is NOT in the incoming changes, or IS in the changes but DELETED in the original.
+#    A not yet deleted original is set to IsDeleted=True; an already deleted one is set to IsCurrent=False
+#    (its re-insert, if any, is picked up as I).
+# U: the key is in both with different content, i.e. different HashedNonKeyColumns.
+#    The original (old) row is set to IsCurrent=False and is accompanied by an I for the new row.
+# I: the key is in the changes and NOT in the original (or only as a deleted row), or it accompanies a U.
 #
+# Old-side rows (U, D) carry the original's RecordStartDate and HashedNonKeyColumns so the merge matches them
+# to the current row; new-side rows (I) carry the change's RecordStartDate and never match.
 ####
-df_updates_new = (
-    dfDataOriginal.alias('original')
-    .join(
-        dfDataChanged.alias('changes'),
-        (dfDataChanged.HashedPKColumn == dfDataOriginal.HashedPKColumn) &
-        (dfDataOriginal.IsDeleted.cast('boolean') == lit(False).cast('boolean')) &
-        (dfDataOriginal.IsCurrent.cast('boolean') == lit(True).cast('boolean')),
-        how='inner'
-    )
-    .where("changes.HashedNonKeyColumns <> original.HashedNonKeyColumns")
-    .select(
-        "changes.HashedPKColumn",
-        lit('I').alias('Action'),
-        *columns_to_insert_deletes
-    )
-    .withColumn('RecordEndDate', lit('9999-12-31').cast('timestamp'))
-    .withColumn('IsCurrent', lit(True))
-    .withColumn('IsDeleted', lit(False))
-)
+original_present = col('original.HashedPKColumn').isNotNull()
+changes_present = col('changes.HashedPKColumn').isNotNull()
+original_deleted = col('original.IsDeleted') == True
 
-#### Process updated records (old rows)
-#
-# Here, we identify all of the records that are:
-#   - IN the incoming changes, AND IN the original, but
-#     with different content, i.e. different HashedNonKeyColumns
-#
-# Here, we isolate the rows from the original (old) because we 
-# need to UPDATE the old rows.
-#
-####
-df_updates_old = (
-    dfDataOriginal.alias('original')
-    .join(
-        dfDataChanged.alias('changes'),
-        (dfDataChanged.HashedPKColumn == dfDataOriginal.HashedPKColumn) &
-        (dfDataOriginal.IsDeleted.cast('boolean') == lit(False).cast('boolean')) &
-        (dfDataOriginal.IsCurrent.cast('boolean') == lit(True).cast('boolean')),
-        how='inner'
-    )
-    .where("changes.HashedNonKeyColumns <> original.HashedNonKeyColumns")
-    .select(
-        "changes.HashedPKColumn",
-        "changes.RecordStartDate",
-        lit('U').alias('Action'),
-        *columns_original
-    )
-    .withColumn('RecordEndDate', expr("changes.RecordStartDate - interval 0.001 seconds"))
-    .drop(col("changes.RecordStartDate"))
-    .withColumn('IsCurrent', lit(False))
-    .withColumn('IsDeleted', lit(False))
-)
+old_action = (when(original_present & (~changes_present | original_deleted), lit('D'))
+              .when(original_present & changes_present & (col('changes.HashedNonKeyColumns') != col('original.HashedNonKeyColumns')), lit('U')))
+new_action = (when(changes_present & (~original_present | original_deleted), lit('I'))
+              .when(changes_present & (col('changes.HashedNonKeyColumns') != col('original.HashedNonKeyColumns')), lit('I')))
 
-#### Process inserted records
-#
-# Here, we identify all of the records that are:
-#   - IN the incoming changes, and NOT IN the original
-#
-# We need to INSERT these rows.
-#
-####
-df_inserts = (
-    dfDataChanged.alias("changes")
-    .join(
-        dfDataOriginal.alias("original"),
-        (col("changes.HashedPKColumn") == col("original.HashedPKColumn")) &
-        (col("original.IsCurrent") == True) &
-        (col("original.IsDeleted") == False),
-        how="left"
-    )
-    .where(col("original.HashedPKColumn").isNull())
-    .select(
-        col("changes.HashedPKColumn"),
-        lit("I").alias("Action"),
-        *columns_to_insert_deletes
-    )
-    .withColumn("RecordEndDate", lit("9999-12-31").cast("timestamp"))
-    .withColumn("IsCurrent", lit(True))
-    .withColumn("IsDeleted", lit(False))
-)
+def _side_value(column):
+    """Take the column from the change for inserts and from the current original otherwise."""
+    changes_value = col(f'changes.{column}') if column in dfDataChanged.columns else lit(None)
+    return when(col('Action') == 'I', changes_value).otherwise(col(f'original.{column}'))
 
-### Final merged DataFrame
-#
-# Here, we merge all of the changed we plan to do: inserts, updates, and deletes.
-# The operation that is listed under 'Action' identifies what happens:
-#
-# For rows marked as D:
-#     If the current row IS NOT marked as IsDeleted: we set IsDeleted to True.
-#     If the current row IS marked as IsDeleted: we set IsCurrent to False
-#
-# For rows marked as U:
-#     The current row is set to IsCurrent=False
-#
-# For rows marked as I:
-#     The row is inserted with IsCurrent=True
-#
 dfDataChanged = (
-    df_deletes
-    .unionByName(df_updates_new)
-    .unionByName(df_updates_old)
-    .unionByName(df_inserts)
+    dfDataCurrent.alias('original')
+    .join(dfDataChanged.alias('changes'), col('original.HashedPKColumn') == col('changes.HashedPKColumn'), how='full_outer')
+    .withColumn('Action', explode(array(old_action, new_action)))
+    .where(col('Action').isNotNull())
+    .select(
+        coalesce(col('changes.HashedPKColumn'), col('original.HashedPKColumn')).alias('HashedPKColumn'),
+        _side_value('HashedNonKeyColumns').alias('HashedNonKeyColumns'),
+        _side_value('RecordStartDate').alias('RecordStartDate'),
+        _side_value('RecordModifiedDate').alias('RecordModifiedDate'),
+        when(col('Action') == 'I', lit('9999-12-31').cast('timestamp'))
+            .when(col('Action') == 'U', expr("changes.RecordStartDate - interval 0.001 seconds"))
+            .otherwise(current_timestamp()).alias('RecordEndDate'),
+        (col('Action') == 'I').alias('IsCurrent'),
+        (col('Action') == 'D').alias('IsDeleted'),
+        col('Action'),
+        *[_side_value(column).alias(column) for column in dfDataOriginal.columns if column not in SCD2_TRACKING_COLUMNS]
+    )
 )
 
 # METADATA ********************
@@ -617,9 +574,10 @@ columns_to_insert = {column: f"updates.{column}" for column in dfDataOriginal.co
 
 try:
     deltaTable = DeltaTable.forPath(spark, f'{target_data_path}')
+    target_version_before_merge = deltaTable.history(1).select("version").first()[0]
 
     merge = deltaTable.alias('original') \
-        .merge(dfDataChanged.alias('updates'), 'original.HashedPKColumn = updates.HashedPKColumn and original.RecordStartDate = updates.RecordStartDate') \
+        .merge(dfDataChanged.alias('updates'), 'original.IsCurrent = true and original.HashedPKColumn = updates.HashedPKColumn and original.RecordStartDate = updates.RecordStartDate') \
         .whenMatchedUpdate(
                 #
                 # Handle rows to be (soft-) deleted:
@@ -657,11 +615,16 @@ try:
 
     # Execute the merge operation
     merge.execute()
+    if use_change_feed:
+        spark.sql(f"ALTER TABLE delta.`{target_data_path}` SET TBLPROPERTIES ('{SOURCE_VERSION_PROPERTY}' = '{source_version}')")
+    if changed_keys is not None:
+        dfSourceChanges.unpersist()
 except Exception as e:
     # Ensure audit log is written even on failure
     error_data = {"Action": "Error", "ErrorMessage": str(e)[:500]}
     try:
-        execute_with_outputs(EndNotebookActivity, driver, connstring, database, LogData=json.dumps(error_data))
+        queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(error_data), LogType="FailNotebookActivity")
+        flush_sql_calls()
 
     except Exception as audit_error:
         print(f"Audit logging failed: {audit_error}")  # best-effort audit logging
@@ -682,6 +645,10 @@ except Exception as e:
 
 # CELL ********************
 
+# Merge metrics
+merge_metrics = get_merge_metrics(target_data_path, since_version=target_version_before_merge)
+print(f"Merge metrics: {merge_metrics}")
+
 TotalRuntime = str((datetime.now() - start_audit_time)) 
 end_audit_time =  str(datetime.now())
 start_audit_time =str(start_audit_time)
@@ -693,9 +660,11 @@ result_data = {
         "TargetName" : TargetName,
         "EntityId" : SilverLayerEntityId,
         "StartTime" : start_audit_time,
-        "EndTime" : end_audit_time
+        "EndTime" : end_audit_time,
+        **merge_metrics
 
-    }
+    },
+    "Instrumentation": get_instrumentation()
     }
 
 # METADATA ********************
@@ -707,8 +676,8 @@ result_data = {
 
 # CELL ********************
 
-execute_with_outputs(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="True", BronzeLayerEntityId=BronzeLayerEntityId)
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
+queue_sql_call(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="True", BronzeLayerEntityId=BronzeLayerEntityId)
+queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
 
 # METADATA ********************
 
@@ -723,7 +692,7 @@ execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_pa
 
 # CELL ********************
 
-notebookutils.notebook.exit(result_data)
+exit_notebook(result_data)
 
 # METADATA ********************
 
@@ -26,17 +26,21 @@
 # - **Source File Validation**: Checks if source files exist before processing
 # - **Data Quality Checks**: Validates primary keys and detects duplicates
 # - **Cleansing Rules**: Applies configurable cleansing rules from the framework database
+# - **Data Quality Checks**: Evaluates the checks in dq_rules in one aggregate pass and reports them in the audit log
 # - **Change Detection**: Uses hash columns to detect changes in data
-# - **Incremental Loading**: Supports both full and incremental load patterns
+# - **Incremental Loading**: Supports both full and incremental load patterns; incremental batches append new keys and only merge changed ones
 # - **Audit Logging**: Tracks execution details in the framework database
 # - **Delta Lake Integration**: Writes data to Delta tables with optimization settings
 # 
+# The load itself is `load_landing_to_bronze` in NB_FMD_LOAD_LANDING_BRONZE_FUNCTIONS, which the parallel
+# orchestrator can also run for many entities inside one Spark session (`SchedulingMode = "inprocess"`).
+# 
 # ## Process Flow
 # 1. Load libraries and configuration settings
 # 2. Set up audit logging and database connections
-# 3. Read source file from Landing Zone (Parquet/CSV)
-# 4. Perform data quality checks (PK validation, duplicate detection)
-# 5. Apply cleansing rules from framework configuration
+# 3. Read source file from Landing Zone (Parquet/CSV). CSV files are read with the schema registered for the entity (learned on the first load)
+# 4. Perform data quality checks (PK validation, duplicate detection) on a cached copy of the source, so the file is read once
+# 5. Apply cleansing rules from framework configuration and evaluate the data quality checks
 # 6. Add hash columns for change tracking
 # 7. Execute incremental or full load to Bronze Delta table
 # 8. Update processing status and complete audit logging
@@ -66,6 +70,9 @@ SourceLakehouse = ''
 SourceLakehouseName = ''
 SourceFilePath = ''
 SourceFileName = ''
+# Coalesced load: JSON list of {"SourceFilePath", "SourceFileName"} oldest first; the newest row per key wins.
+# A full load (IsIncremental False) reads only the newest file and marks the older ones processed
+SourceFiles = ''
 DataSourceNamespace = ''
 
 TargetWorkspace = ''
@@ -84,6 +91,10 @@ EscapeCharacter = '"'
 Encoding = 'UTF-8'
 first_row_is_header = True
 infer_schema = True
+# # Excel: '' = first sheet, '*' = all sheets, or a list separated by , or ;
+SheetName = ''
+# # Bronze layout: partition a new Bronze table on the first N hex characters of HashedPKColumn (0 = not partitioned)
+PKBucketLength = 0
 key_vault =default_settings.key_vault_uri_name
 cleansing_rules = []
 dq_rules = []
@@ -94,44 +105,9 @@ connstring=config_settings.fmd_fabric_db_connection
 database=config_settings.fmd_fabric_db_name
 schema_enabled =default_settings.lakehouse_schema_enabled
 EntityLayer='Bronze'
+AsyncAuditLogging = False
 result_data=''
 
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Load Libraries
-
-# CELL ********************
-
-import re
-from datetime import datetime, timezone
-import json
-from delta.tables import *
-from pyspark.sql.functions import sha2, md5, concat_ws, current_timestamp
-from pyspark.sql.types import StringType
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Define Starttime
-
-# CELL ********************
-
-start_audit_time = datetime.now()
-
-
 # METADATA ********************
 
 # META {
@@ -165,287 +141,6 @@ token =  notebookutils.credentials.getToken('https://analysis.windows.net/powerb
 # META   "language_group": "synapse_pyspark"
 # META }
 
-# MARKDOWN ********************
-
-# ## Define Stored Procedures for Logging
-
-# CELL ********************
-
-# Ensure TriggerTime is formatted correctly
-TriggerTime = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-notebook_name=  notebookutils.runtime.context['currentNotebookName']
-
-
-# Stored procedure names
-SP_UPSERT_LDZ_ENTITY = "[execution].[sp_UpsertPipelineLandingzoneEntity]"
-SP_UPSERT_BRONZE_ENTITY = "[execution].[sp_UpsertPipelineBronzeLayerEntity]"
-SP_AUDIT_NOTEBOOK = "[logging].[sp_AuditNotebook]"
-SP_GET_CLEANSING_RULE = "[execution].[sp_GetBronzeCleansingRule]"
-SP_GET_DQ_RULE = "[execution].[sp_GetBronzeDQRule]"
-
-# Common audit parameters
-audit_params = {
-    "NotebookGuid": NotebookExecutionId,
-    "NotebookName": notebook_name,
-    "PipelineRunGuid": PipelineRunGuid,
-    "PipelineParentRunGuid": PipelineParentRunGuid,
-    "NotebookParameters": TargetName,
-    "TriggerType": TriggerType,
-    "TriggerGuid": TriggerGuid,
-    "TriggerTime": TriggerTime,
-    "WorkspaceGuid": SourceWorkspace,
-    "EntityId": BronzeLayerEntityId,
-    "EntityLayer": EntityLayer,
-}
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Set Configuration
-
-# CELL ********************
-
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# CELL ********************
-
-#Make sure you have disabled V-Order, Bronze we want to load fast
-spark.conf.set("spark.sql.parquet.int96RebaseModeInRead", "CORRECTED")
-spark.conf.set("spark.sql.parquet.int96RebaseModeInWrite", "CORRECTED")
-spark.conf.set("spark.sql.parquet.datetimeRebaseModeInRead", "CORRECTED")
-spark.conf.set("spark.sql.parquet.datetimeRebaseModeInWrite", "CORRECTED")
-
-spark.conf.set('spark.microsoft.delta.optimize.fast.enabled', True)
-spark.conf.set('spark.microsoft.delta.optimize.fileLevelTarget.enabled', True)
-spark.conf.set('spark.databricks.delta.autoCompact.enabled', True)
-
-spark.conf.set("spark.fabric.resourceProfile", "writeHeavy")
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Set your loading paths
-
-# CELL ********************
-
-#Set SourceFile and target Location
-source_changes_data_path = f"abfss://{SourceWorkspace}@onelake.dfs.fabric.microsoft.com/{SourceLakehouse}/Files/{SourceFilePath}/{SourceFileName}"
-print(source_changes_data_path)
-
-if str(schema_enabled).lower() == "true":
-    target_data_path = f"abfss://{TargetWorkspace}@onelake.dfs.fabric.microsoft.com/{TargetLakehouse}/Tables/{DataSourceNamespace}/{TargetSchema}_{TargetName}"
-else:
-    target_data_path = f"abfss://{TargetWorkspace}@onelake.dfs.fabric.microsoft.com/{TargetLakehouse}/Tables/{DataSourceNamespace}_{TargetSchema}_{TargetName}"
-print(target_data_path)
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Load new from Data Landingzone
-
-# CELL ********************
-
-if not notebookutils.fs.exists(source_changes_data_path):
-    print("❌ Source file not found. Exiting Notebook")
-    execute_with_outputs(SP_UPSERT_LDZ_ENTITY, driver, connstring, database, Filename=SourceFileName, FilePath=SourceFilePath, IsProcessed="True", LandingzoneEntityId=LandingzoneEntityId)
-    TotalRuntime = str((datetime.now() - start_audit_time))
-    end_audit_time =  str(datetime.now())
-    start_audit_time =str(start_audit_time)
-    result_data = {
-    "Action" : "End", "CopyOutput":{
-        "Total Runtime": TotalRuntime,
-        "TargetSchema": TargetSchema,
-        "TargetName" : TargetName,
-        "SourceFilePath" : SourceFilePath,
-        "SourceFileName" : 'FILE NOT FOUND',
-        "LandingzoneEntityId" : LandingzoneEntityId,
-        "EntityId" : BronzeLayerEntityId,
-        "StartTime" : start_audit_time,
-        "EndTime" : end_audit_time
-
-    }
-    }
-    execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
-    
-    notebookutils.notebook.exit(result_data)
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# CELL ********************
-
-if SourceFileType=='csv':
-    dfDataChanged = (
-        spark.read
-            .option("header", True)            # first row has column names
-            .option("inferSchema", True)       # ask Spark to infer types
-            .option("samplingRatio", 0.1)      # sample 10% of rows; omit to scan fully
-            .csv(f"{source_changes_data_path}")
-    )
-elif SourceFileType=='xlsx':
-    # Basic read: entire first sheet, header row present, types inferred
-    import pandas as pd
-    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "false")
-    pdf = pd.read_excel(f"{source_changes_data_path}", engine="openpyxl")
-    dfDataChanged = spark.createDataFrame(pdf)
-
-elif SourceFileType=='xls':
-    # Basic read: entire first sheet, header row present, types inferred
-    import pandas as pd
-    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "false")
-    pdf = pd.read_excel(f"{source_changes_data_path}", engine="xlrd")
-    dfDataChanged = spark.createDataFrame(pdf)
-
-else:
-    #Read all incoming changes in Parquet format
-    dfDataChanged= spark.read\
-                    .format(SourceFileType) \
-                    .option("header","true") \
-                    .load(f"{source_changes_data_path}")
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# CELL ********************
-
-# Replace spaces with underscores in column names
-new_columns = [col.replace(' ', '') for col in dfDataChanged.columns]
-
-# Rename the columns
-dfDataChanged = dfDataChanged.toDF(*new_columns)
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## DQ Checks
-
-# CELL ********************
-
-#split PKcolumns string on , ; or :
-PrimaryKeys = str(PrimaryKeys)
-
-PrimaryKeys = re.split('[, ; :]', PrimaryKeys)
-#remove potential whitespaces around Pk columns 
-PrimaryKeys = [column.strip() for column in PrimaryKeys if column != ""]
-
-key_columns = PrimaryKeys
-print(f": {', '.join(key_columns)}")
-# Check if all PK's exist in source
-for pk_column in key_columns:
-    if pk_column not in dfDataChanged.columns:
-        raise ValueError(f"PK: {pk_column} doesn't exist in the source.")
-        # Define all the Non-Key columns => HashExcludeColumns
-
-# Order the key columns by PrimaryKeys, not by the source, so that the hash of a row
-# does not change when the source hands its columns over in a different order.
-# Also deduplicate while preserving order to avoid hashing the same PK column twice.
-read_key_columns = list(dict.fromkeys(key_columns))
-
-# Add a column with the calculated hash, easier in later stage of with multiple PK
-dfDataChanged = (dfDataChanged
-                .withColumn("HashedPKColumn", sha2(concat_ws("||", *read_key_columns), 256)))
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Check for Duplicates
-
-# CELL ********************
-
-dup_count = dfDataChanged.groupBy('HashedPKColumn').count().where('count > 1').limit(1).collect()
-if dup_count:
-    raise ValueError(f'Source file contains duplicated rows for PK: {", ".join(key_columns)}')
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Perform Cleansing
-
-# CELL ********************
-
-if cleansing_rules == "":
-    cleansing_rules = []
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# CELL ********************
-
-CleansingRules=execute_with_outputs(SP_GET_CLEANSING_RULE, driver, connstring, database, BronzeLayerEntityId=BronzeLayerEntityId)
-rules_str = None
-# Extract the string
-rules_str = CleansingRules["result_sets"][0][0]["CleansingRules"]
-if rules_str != None :
-# Convert JSON text → Python dict/list
-    cleansing_rules = json.loads(rules_str)
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
 # CELL ********************
 
 %run NB_FMD_DQ_CLEANSING
@@ -459,151 +154,7 @@ if rules_str != None :
 
 # CELL ********************
 
-dfDataChanged=handle_cleansing_functions(dfDataChanged,cleansing_rules)
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Add Hash
-
-# CELL ********************
-
-non_key_columns = [column for column in dfDataChanged.columns if column not in key_columns and column != 'HashedPKColumn']
-
-#add a hashed cloumn to detect changes
-dfDataChanged = dfDataChanged.withColumn("HashedNonKeyColumns", md5(concat_ws("||", *non_key_columns).cast(StringType())))
-
-#Add RecordLoadDate to see when the record arrived
-dfDataChanged = dfDataChanged.withColumn('RecordLoadDate', current_timestamp())
-
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Read Original if exists
-
-# CELL ********************
-
-#Check if Target exist, if exists read the original data if not create table and exit
-if DeltaTable.isDeltaTable(spark, target_data_path):
-    # Read original/current data
-    dfDataOriginal = (spark
-                        .read.format("delta")
-                        .load(target_data_path)
-                        )
-
-else:
-    # Use first load when no data exists yet and then exit 
-    dfDataChanged.write.format("delta").mode("overwrite").save(target_data_path)
-    TotalRuntime = str((datetime.now() - start_audit_time)) 
-    end_audit_time =  str(datetime.now())
-    start_audit_time =str(start_audit_time)
-    # Your data
-    result_data = {
-        "Action" : "End", "CopyOutput":{
-            "Total Runtime": TotalRuntime,
-            "TargetSchema": TargetSchema,
-            "TargetName" : TargetName,
-            "SourceFilePath" : SourceFilePath,
-            "SourceFileName" : SourceFileName,
-            "LandingzoneEntityId" : LandingzoneEntityId,
-            "EntityId" : BronzeLayerEntityId,
-            "StartTime" : start_audit_time,
-            "EndTime" : end_audit_time
-
-        }
-        }
-
-    execute_with_outputs(SP_UPSERT_LDZ_ENTITY, driver, connstring, database, Filename=SourceFileName, FilePath=SourceFilePath, IsProcessed="True", LandingzoneEntityId=LandingzoneEntityId)
-    execute_with_outputs(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="False", BronzeLayerEntityId=BronzeLayerEntityId)
-    execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
-    notebookutils.notebook.exit(result_data)
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Merge table
-
-# CELL ********************
-
-#merge table
-try:
-    deltaTable = DeltaTable.forPath(spark, f'{target_data_path}')
-    if IsIncremental in [False, 'false', 'False']:
-        print(' - Incremental Loading is not enabled, deletes are allowed')
-        merge = deltaTable.alias('original') \
-            .merge(dfDataChanged.alias('updates'), 'original.HashedPKColumn == updates.HashedPKColumn') \
-            .whenNotMatchedInsertAll() \
-            .whenMatchedUpdateAll('original.HashedNonKeyColumns != updates.HashedNonKeyColumns') \
-            .whenNotMatchedBySourceDelete() \
-            .execute()
-    else:
-        print(' - Incremental Loading is enabled, deletes are not allowed')
-        merge = deltaTable.alias('original') \
-            .merge(dfDataChanged.alias('updates'), 'original.HashedPKColumn == updates.HashedPKColumn') \
-            .whenNotMatchedInsertAll() \
-            .whenMatchedUpdateAll('original.HashedNonKeyColumns != updates.HashedNonKeyColumns') \
-            .execute()
-except Exception as e:
-    # Ensure audit log is written even on failure
-    error_data = {"Action": "Error", "ErrorMessage": str(e)[:500]}
-    try:
-        execute_with_outputs(EndNotebookActivity, driver, connstring, database, LogData=json.dumps(error_data))
-    except Exception as audit_log_error:
-        print(f"Audit logging failed: {audit_log_error}")  # best-effort audit logging
-
-
-    raise
-
-# METADATA ********************
-
-# META {
-# META   "language": "python",
-# META   "language_group": "synapse_pyspark"
-# META }
-
-# MARKDOWN ********************
-
-# ## Define Results
-
-# CELL ********************
-
-TotalRuntime = str((datetime.now() - start_audit_time)) 
-end_audit_time =  str(datetime.now())
-start_audit_time =str(start_audit_time)
-# Your data
-result_data = {
-    "Action" : "End", "CopyOutput":{
-        "Total Runtime": TotalRuntime,
-        "TargetSchema": TargetSchema,
-        "TargetName" : TargetName,
-        "SourceFilePath" : SourceFilePath,
-        "SourceFileName" : SourceFileName,
-        "LandingzoneEntityId" : LandingzoneEntityId,
-        "EntityId" : BronzeLayerEntityId,
-        "StartTime" : start_audit_time,
-        "EndTime" : end_audit_time
-
-    }
-    }
+%run NB_FMD_LOAD_LANDING_BRONZE_FUNCTIONS
 
 # METADATA ********************
 
@@ -614,13 +165,14 @@ result_data = {
 
 # MARKDOWN ********************
 
-# ## Logging and update queue
+# ## Load Landing Zone to Bronze
 
 # CELL ********************
 
-execute_with_outputs(SP_UPSERT_LDZ_ENTITY, driver, connstring, database, Filename=SourceFileName, FilePath=SourceFilePath, IsProcessed="True", LandingzoneEntityId=LandingzoneEntityId)
-execute_with_outputs(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="False", BronzeLayerEntityId=BronzeLayerEntityId)
-execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(result_data), LogType="EndNotebookActivity")
+configure_bronze_session()
+# The parameters of this notebook, plus the runtime parameters injected by the orchestrator
+load_parameters = {name: globals()[name] for name in BRONZE_LOAD_DEFAULTS if name in globals()}
+result_data = load_landing_to_bronze(load_parameters)
 
 # METADATA ********************
 
@@ -632,10 +184,11 @@ execute_with_outputs(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_pa
 # MARKDOWN ********************
 
 # ## Notebook exit
+# The queued landing, Bronze and audit updates are written in one round-trip when the notebook exits.
 
 # CELL ********************
 
-notebookutils.notebook.exit(result_data)
+exit_notebook(result_data)
 
 # METADATA ********************
 
@@ -0,0 +1,651 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "synapse_pyspark"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse_name": "",
+# META       "default_lakehouse_workspace_id": ""
+# META     }
+# META   }
+# META }
+
+# MARKDOWN ********************
+
+# # Landing Zone to Bronze load functions
+#
+# The Landing Zone to Bronze load as a function, `load_landing_to_bronze(parameters)`, so it can run
+# as a notebook (NB_FMD_LOAD_LANDING_BRONZE) or for many entities inside one Spark session
+# (NB_FMD_PROCESSING_PARALLEL_MAIN with `SchedulingMode = "inprocess"`).
+#
+# Requires `%run NB_FMD_UTILITY_FUNCTIONS` and `%run NB_FMD_DQ_CLEANSING` before this notebook.
+# The function queues its metadata writes with `queue_sql_call` and the caller flushes them;
+# only the FailNotebookActivity audit of a failed load is flushed before the error is raised.
+
+# CELL ********************
+
+config_settings=notebookutils.variableLibrary.getLibrary("VAR_CONFIG_FMD")
+default_settings=notebookutils.variableLibrary.getLibrary("VAR_FMD")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+import os
+import re
+from datetime import datetime, timezone
+from functools import reduce
+import json
+from delta.tables import *
+from pyspark import StorageLevel
+from pyspark.sql import Window
+from pyspark.sql.functions import sha2, md5, concat_ws, current_timestamp, substring, col, lit, when, row_number, max as max_value, sum as sum_values
+from pyspark.sql.types import StringType
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# ## Stored procedures and parameters
+
+# CELL ********************
+
+# Stored procedure names
+SP_UPSERT_LDZ_ENTITY = "[execution].[sp_UpsertPipelineLandingzoneEntity]"
+SP_UPSERT_BRONZE_ENTITY = "[execution].[sp_UpsertPipelineBronzeLayerEntity]"
+SP_AUDIT_NOTEBOOK = "[logging].[sp_AuditNotebook]"
+SP_GET_CLEANSING_RULE = "[execution].[sp_GetBronzeCleansingRule]"
+SP_GET_DQ_RULE = "[execution].[sp_GetBronzeDQRule]"
+
+# Parameters of a Landing Zone to Bronze load and their defaults, as in NB_FMD_LOAD_LANDING_BRONZE
+BRONZE_LOAD_DEFAULTS = {
+    "PrimaryKeys": "",
+    "SourceFileType": "parquet",
+    "IsIncremental": False,
+    "SourceWorkspace": "",
+    "SourceLakehouse": "",
+    "SourceFilePath": "",
+    "SourceFileName": "",
+    "SourceFiles": "",
+    "DataSourceNamespace": "",
+    "TargetWorkspace": "",
+    "TargetLakehouse": "",
+    "TargetSchema": "",
+    "TargetName": "",
+    "LandingzoneEntityId": "",
+    "BronzeLayerEntityId": "",
+    "CompressionType": "infer",
+    "ColumnDelimiter": ",",
+    "RowDelimiter": "\n",
+    "EscapeCharacter": '"',
+    "Encoding": "UTF-8",
+    "first_row_is_header": True,
+    "infer_schema": True,
+    "SheetName": "",
+    "PKBucketLength": 0,
+    "cleansing_rules": [],
+    "dq_rules": [],
+    "driver": "{ODBC Driver 18 for SQL Server}",
+    "connstring": config_settings.fmd_fabric_db_connection,
+    "database": config_settings.fmd_fabric_db_name,
+    "schema_enabled": default_settings.lakehouse_schema_enabled,
+    "EntityLayer": "Bronze",
+    "AsyncAuditLogging": False,
+    # Injected by the orchestrator
+    "NotebookExecutionId": "",
+    "NotebookName": "",
+    "PipelineRunGuid": "",
+    "PipelineParentRunGuid": "",
+    "TriggerType": "",
+    "TriggerGuid": "",
+}
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# ## Set Configuration
+# Session settings; set once per Spark session, before the first load.
+
+# CELL ********************
+
+def configure_bronze_session():
+    #Make sure you have disabled V-Order, Bronze we want to load fast
+    spark.conf.set("spark.sql.parquet.int96RebaseModeInRead", "CORRECTED")
+    spark.conf.set("spark.sql.parquet.int96RebaseModeInWrite", "CORRECTED")
+    spark.conf.set("spark.sql.parquet.datetimeRebaseModeInRead", "CORRECTED")
+    spark.conf.set("spark.sql.parquet.datetimeRebaseModeInWrite", "CORRECTED")
+
+    spark.conf.set('spark.microsoft.delta.optimize.fast.enabled', True)
+    spark.conf.set('spark.microsoft.delta.optimize.fileLevelTarget.enabled', True)
+    spark.conf.set('spark.databricks.delta.autoCompact.enabled', True)
+
+    spark.conf.set("spark.fabric.resourceProfile", "writeHeavy")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# ## Landing Zone files
+
+# CELL ********************
+
+def landing_file_path(p, source_file):
+    return f"abfss://{p['SourceWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['SourceLakehouse']}/Files/{source_file['SourceFilePath']}/{source_file['SourceFileName']}"
+
+
+def bronze_table_path(p):
+    if str(p["schema_enabled"]).lower() == "true":
+        return f"abfss://{p['TargetWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['TargetLakehouse']}/Tables/{p['DataSourceNamespace']}/{p['TargetSchema']}_{p['TargetName']}"
+    return f"abfss://{p['TargetWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['TargetLakehouse']}/Tables/{p['DataSourceNamespace']}_{p['TargetSchema']}_{p['TargetName']}"
+
+
+def excel_staging_path(p, file_index=None):
+    """Parquet staging folder of the Excel files of an entity, or of its file_index-th file."""
+    path = f"abfss://{p['SourceWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['SourceLakehouse']}/Files/_fmd_staging/{p['LandingzoneEntityId']}"
+    return path if file_index is None else f"{path}/{file_index}"
+
+
+def read_landing_file(p, source_path, file_index=0):
+    """Read one landing file into a DataFrame according to SourceFileType."""
+    SourceFileType = p["SourceFileType"]
+    if SourceFileType=='csv':
+        # Spark picks the codec from the file extension, so check that it matches CompressionType
+        csv_compression_extensions = {"gzip": ".gz", "bzip2": ".bz2", "deflate": ".deflate", "lz4": ".lz4", "snappy": ".snappy", "zstd": ".zst"}
+        compression = str(p["CompressionType"]).lower()
+        if compression in csv_compression_extensions and not os.path.basename(source_path).lower().endswith(csv_compression_extensions[compression]):
+            raise ValueError(f"CompressionType '{p['CompressionType']}' expects a file ending in '{csv_compression_extensions[compression]}', got '{os.path.basename(source_path)}'")
+
+        csv_options = {
+            "header": str(p["first_row_is_header"]).lower() == "true",
+            "sep": p["ColumnDelimiter"],
+            "encoding": p["Encoding"],
+            "escape": p["EscapeCharacter"],
+        }
+        # Spark already splits on \n and \r\n; any other single-character row delimiter must be set explicitly
+        if p["RowDelimiter"] and p["RowDelimiter"] not in ("\n", "\r\n"):
+            csv_options["lineSep"] = p["RowDelimiter"]
+
+        if str(p["infer_schema"]).lower() != "true":
+            # All columns as string, no registry involved
+            return spark.read.options(**csv_options).csv(source_path)
+        else:
+            registry_path = schema_registry_path(p["SourceWorkspace"], p["SourceLakehouse"], p["LandingzoneEntityId"])
+            registered_schema = load_registered_schema(registry_path)
+            # Without inferSchema Spark only reads the first line to get the column names
+            file_columns = spark.read.options(**csv_options).csv(source_path).columns
+
+            if registered_schema is not None and registered_schema.fieldNames() == file_columns:
+                # FAILFAST: a value that does not fit the registered type fails the load instead of becoming null
+                return (
+                    spark.read
+                        .options(**csv_options)
+                        .option("mode", "FAILFAST")
+                        .schema(registered_schema)
+                        .csv(source_path)
+                )
+            else:
+                if registered_schema is not None:
+                    print(f"Columns changed since the schema was registered, learning the schema again: {registry_path}")
+                # Learn the schema from the whole file once, then register it for the next loads
+                dfFile = (
+                    spark.read
+                        .options(**csv_options)
+                        .option("inferSchema", True)
+                        .csv(source_path)
+                )
+                save_registered_schema(registry_path, dfFile.schema, p["LandingzoneEntityId"])
+                return dfFile
+    elif SourceFileType in ('xlsx', 'xls'):
+        # Streamed in chunks to a per-entity Parquet staging folder, header row present, types inferred
+        # The folder is removed by load_landing_to_bronze once the load is done
+        return read_excel_to_spark(source_path, SourceFileType, excel_staging_path(p, file_index), p["SheetName"])
+
+    else:
+        #Read all incoming changes in Parquet format
+        return spark.read\
+                        .format(SourceFileType) \
+                        .option("header","true") \
+                        .load(f"{source_path}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# ## Load Landing Zone to Bronze
+# Reads the landing files, checks and cleanses them, and merges them into the Bronze table.
+# Returns result_data; the landing, Bronze and audit updates are queued with queue_sql_call.
+
+# CELL ********************
+
+def load_landing_to_bronze(parameters):
+    """Load the landing files of one entity into Bronze and return result_data.
+    A failure is audited as FailNotebookActivity before it is raised."""
+    p = {**BRONZE_LOAD_DEFAULTS, **parameters}
+    driver, connstring, database = p["driver"], p["connstring"], p["database"]
+
+    start_audit_time = datetime.now()
+    # Stage timings and metrics of this load only, also when the thread ran an earlier load
+    reset_instrumentation()
+
+    # Ensure TriggerTime is formatted correctly
+    TriggerTime = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    # Common audit parameters
+    audit_params = {
+        "NotebookGuid": p["NotebookExecutionId"],
+        "NotebookName": p["NotebookName"] or notebookutils.runtime.context['currentNotebookName'],
+        "PipelineRunGuid": p["PipelineRunGuid"],
+        "PipelineParentRunGuid": p["PipelineParentRunGuid"],
+        "NotebookParameters": p["TargetName"],
+        "TriggerType": p["TriggerType"],
+        "TriggerGuid": p["TriggerGuid"],
+        "TriggerTime": TriggerTime,
+        "WorkspaceGuid": p["SourceWorkspace"],
+        "EntityId": p["BronzeLayerEntityId"],
+        "EntityLayer": p["EntityLayer"],
+    }
+
+    start_stage("Logging")
+    if str(p["AsyncAuditLogging"]).lower() == "true":
+        enable_async_audit_logging(driver, connstring, database)
+    execute_audit_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData='{"Action":"Start"}', LogType="StartNotebookActivity")
+
+    try:
+        return _load_landing_files(p, audit_params, start_audit_time)
+    except Exception as e:
+        # Ensure audit log is written even on failure
+        error_data = {"Action": "Error", "ErrorMessage": str(e)[:500]}
+        try:
+            queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=json.dumps(error_data), LogType="FailNotebookActivity")
+            flush_sql_calls()
+        except Exception as audit_log_error:
+            print(f"Audit logging failed: {audit_log_error}")  # best-effort audit logging
+        raise
+    finally:
+        # The Excel sheets were staged as Parquet for this load only; Bronze has been written by now
+        if p["SourceFileType"] in ('xlsx', 'xls'):
+            try:
+                if notebookutils.fs.exists(excel_staging_path(p)):
+                    notebookutils.fs.rm(excel_staging_path(p), True)
+            except Exception as e:
+                print(f"Excel staging folder {excel_staging_path(p)} not removed: {e}")
+
+
+def _load_landing_files(p, audit_params, start_audit_time):
+    PrimaryKeys = p["PrimaryKeys"]
+    IsIncremental = p["IsIncremental"]
+    SourceFilePath, SourceFileName = p["SourceFilePath"], p["SourceFileName"]
+    TargetSchema, TargetName = p["TargetSchema"], p["TargetName"]
+    LandingzoneEntityId, BronzeLayerEntityId = p["LandingzoneEntityId"], p["BronzeLayerEntityId"]
+    driver, connstring, database = p["driver"], p["connstring"], p["database"]
+    cleansing_rules = p["cleansing_rules"]
+
+    # Set your loading paths
+    source_files = json.loads(p["SourceFiles"]) if p["SourceFiles"] else [{"SourceFilePath": SourceFilePath, "SourceFileName": SourceFileName}]
+
+    def queue_landing_files_processed(files):
+        for source_file in files:
+            queue_sql_call(SP_UPSERT_LDZ_ENTITY, driver, connstring, database, Filename=source_file["SourceFileName"], FilePath=source_file["SourceFilePath"], IsProcessed="True", LandingzoneEntityId=LandingzoneEntityId)
+
+    print(landing_file_path(p, source_files[-1]))
+
+    target_data_path = bronze_table_path(p)
+    print(target_data_path)
+
+    # Load new from Data Landingzone
+    start_stage("Read")
+    # Missing files are marked processed so they are not offered again
+    missing_files = [source_file for source_file in source_files if not notebookutils.fs.exists(landing_file_path(p, source_file))]
+    queue_landing_files_processed(missing_files)
+    source_files = [source_file for source_file in source_files if source_file not in missing_files]
+
+    # Only incremental batches can be coalesced. A full load merges with deletes, so a key the newest
+    # snapshot dropped would survive from an older file: load the newest snapshot only and mark the
+    # older files processed with it.
+    superseded_files = []
+    if len(source_files) > 1 and IsIncremental in [False, 'false', 'False']:
+        superseded_files, source_files = source_files[:-1], source_files[-1:]
+        print(f"Full load: {len(superseded_files)} older file(s) superseded by {source_files[0]['SourceFileName']}")
+    elif len(source_files) > 1:
+        print(f"Coalescing {len(source_files)} files into one load")
+
+    if not source_files:
+        print("❌ Source file not found. Exiting Notebook")
+        TotalRuntime = str((datetime.now() - start_audit_time))
+        end_audit_time =  str(datetime.now())
+        start_audit_time =str(start_audit_time)
+        result_data = {
+        "Action" : "End", "CopyOutput":{
+            "Total Runtime": TotalRuntime,
+            "TargetSchema": TargetSchema,
+            "TargetName" : TargetName,
+            "SourceFilePath" : SourceFilePath,
+            "SourceFileName" : 'FILE NOT FOUND',
+            "LandingzoneEntityId" : LandingzoneEntityId,
+            "EntityId" : BronzeLayerEntityId,
+            "StartTime" : start_audit_time,
+            "EndTime" : end_audit_time
+
+        }
+        }
+        queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
+        return result_data
+
+    source_changes_data_path = landing_file_path(p, source_files[-1])
+    record_metric("SourceFileBytes", sum(file.size for source_file in source_files for file in notebookutils.fs.ls(landing_file_path(p, source_file))))
+
+    if len(source_files) == 1:
+        dfDataChanged = read_landing_file(p, source_changes_data_path)
+    else:
+        # SourceFileOrder ranks the files for the last-write-wins de-duplication after hashing
+        dfDataChanged = reduce(
+            lambda left, right: left.unionByName(right, allowMissingColumns=True),
+            [read_landing_file(p, landing_file_path(p, source_file), i).withColumn("SourceFileOrder", lit(i)) for i, source_file in enumerate(source_files)]
+        )
+
+    # Replace spaces with underscores in column names
+    new_columns = [column.replace(' ', '') for column in dfDataChanged.columns]
+
+    # Rename the columns
+    dfDataChanged = dfDataChanged.toDF(*new_columns)
+
+    # DQ Checks
+    #split PKcolumns string on , ; or :
+    PrimaryKeys = str(PrimaryKeys)
+
+    PrimaryKeys = re.split('[, ; :]', PrimaryKeys)
+    #remove potential whitespaces around Pk columns
+    PrimaryKeys = [column.strip() for column in PrimaryKeys if column != ""]
+
+    key_columns = PrimaryKeys
+    print(f": {', '.join(key_columns)}")
+    # Check if all PK's exist in source
+    for pk_column in key_columns:
+        if pk_column not in dfDataChanged.columns:
+            raise ValueError(f"PK: {pk_column} doesn't exist in the source.")
+
+    # Order the key columns by PrimaryKeys, not by the source, so that the hash of a row
+    # does not change when the source hands its columns over in a different order.
+    # Also deduplicate while preserving order to avoid hashing the same PK column twice.
+    read_key_columns = list(dict.fromkeys(key_columns))
+
+    # Add a column with the calculated hash, easier in later stage of with multiple PK.
+    # The parsed source is persisted here: the duplicate check below materialises it once
+    # and cleansing, hashing and the merge read from the cache instead of the file again.
+    dfDataChanged = (dfDataChanged
+                    .withColumn("HashedPKColumn", sha2(concat_ws("||", *read_key_columns), 256))
+                    .persist(StorageLevel.MEMORY_AND_DISK))
+    dfSourceCached = dfDataChanged
+    # Released however the load ends, also when a check below raises
+    try:
+        # Check for Duplicates
+        # One aggregate pass gives both the row count and the duplicate check.
+        # Coalesced files may repeat a key across files, only duplicates within one file are an error.
+        coalesce_files = "SourceFileOrder" in dfDataChanged.columns
+        duplicate_key_columns = ['HashedPKColumn', 'SourceFileOrder'] if coalesce_files else ['HashedPKColumn']
+        pk_stats = (dfDataChanged
+                    .groupBy(*duplicate_key_columns).count()
+                    .agg(sum_values('count').alias('RowCount'), max_value('count').alias('MaxRowsPerKey'))
+                    .collect()[0])
+        source_row_count = pk_stats['RowCount'] or 0
+        record_metric("RowsIn", source_row_count)
+        print(f"Source rows: {source_row_count}")
+
+        if (pk_stats['MaxRowsPerKey'] or 0) > 1:
+            raise ValueError(f'Source file contains duplicated rows for PK: {", ".join(key_columns)}')
+
+        if coalesce_files:
+            # Last write wins: keep the row of the newest file per key so the merge sees each key once
+            latest_file_window = Window.partitionBy("HashedPKColumn").orderBy(col("SourceFileOrder").desc())
+            dfDataChanged = (dfDataChanged
+                            .withColumn("SourceFileRank", row_number().over(latest_file_window))
+                            .filter(col("SourceFileRank") == 1)
+                            .drop("SourceFileRank", "SourceFileOrder")
+                            .persist(StorageLevel.MEMORY_AND_DISK))
+            dfSourceCached, dfUnionCached = dfDataChanged, dfSourceCached
+            try:
+                source_row_count = dfDataChanged.count()
+            finally:
+                dfUnionCached.unpersist()
+            record_metric("CoalescedFiles", len(source_files))
+            print(f"Rows after coalescing {len(source_files)} files: {source_row_count}")
+
+        # Perform Cleansing
+        start_stage("Cleansing")
+        if cleansing_rules == "":
+            cleansing_rules = []
+
+        def fetch_cleansing_rules():
+            CleansingRules=execute_with_outputs(SP_GET_CLEANSING_RULE, driver, connstring, database, BronzeLayerEntityId=BronzeLayerEntityId)
+            # Extract the string
+            return CleansingRules["result_sets"][0][0]["CleansingRules"]
+
+        cached_rules = get_cleansing_rules("Bronze", BronzeLayerEntityId, fetch_cleansing_rules,
+                                           cache_path=cleansing_rule_cache_path(p["TargetWorkspace"], p["TargetLakehouse"], "Bronze", BronzeLayerEntityId),
+                                           version=p["PipelineRunGuid"])
+        if cached_rules is not None:
+            cleansing_rules = cached_rules
+
+        dfDataChanged=handle_cleansing_functions(dfDataChanged,cleansing_rules)
+
+        # Data Quality Checks
+        # All checks in dq_rules are evaluated in a single aggregate over the cleansed data; failed checks with severity error stop the load.
+        start_stage("DQ")
+        dq_results = evaluate_dq_rules(dfDataChanged, p["dq_rules"])
+        for result in dq_results:
+            print(f"DQ {result['Severity']:<5} {result['Check']}({result['Column']}): {result['Failed']}/{result['Total']} failed -> {'passed' if result['Passed'] else 'FAILED'}")
+
+        dq_errors = dq_failures(dq_results)
+        if dq_errors:
+            failed_checks = ", ".join(f"{r['Check']}({r['Column']})" for r in dq_errors)
+            raise ValueError(f'Source file failed data quality checks: {failed_checks}')
+
+        # Bronze table layout
+        # A Bronze table can be partitioned on HashedPKBucket, the first PKBucketLength hex characters
+        # of HashedPKColumn. The layout is fixed when the table is created and stored in the table
+        # property fmd.pkBucketLength, so an existing table always keeps its own layout.
+        start_stage("Hash")
+        target_exists = DeltaTable.isDeltaTable(spark, target_data_path)
+        pk_bucket_length = int(p["PKBucketLength"] or 0)
+
+        if target_exists:
+            target_detail = DeltaTable.forPath(spark, target_data_path).detail().first()
+            if "HashedPKBucket" in target_detail.partitionColumns:
+                pk_bucket_length = int(target_detail.properties.get("fmd.pkBucketLength", 0))
+            elif pk_bucket_length:
+                print(f"PKBucketLength is ignored: {target_data_path} is not partitioned on HashedPKBucket. Recreate the table to change its layout.")
+                pk_bucket_length = 0
+
+        if pk_bucket_length:
+            print(f"Bronze table partitioned on the first {pk_bucket_length} character(s) of HashedPKColumn")
+            dfDataChanged = dfDataChanged.withColumn("HashedPKBucket", substring("HashedPKColumn", 1, pk_bucket_length))
+
+        # Add Hash
+        non_key_columns = [column for column in dfDataChanged.columns if column not in key_columns and column not in ('HashedPKColumn', 'HashedPKBucket')]
+
+        #add a hashed cloumn to detect changes
+        dfDataChanged = dfDataChanged.withColumn("HashedNonKeyColumns", md5(concat_ws("||", *non_key_columns).cast(StringType())))
+
+        #Add RecordLoadDate to see when the record arrived
+        dfDataChanged = dfDataChanged.withColumn('RecordLoadDate', current_timestamp())
+
+        # Read Original if exists
+        start_stage("Merge")
+        #Check if Target exist, if exists read the original data if not create table and exit
+        if target_exists:
+            # Read original/current data
+            dfDataOriginal = (spark
+                                .read.format("delta")
+                                .load(target_data_path)
+                                )
+
+        else:
+            # Use first load when no data exists yet and then exit
+            if pk_bucket_length:
+                dfDataChanged.write.format("delta").mode("overwrite").partitionBy("HashedPKBucket").save(target_data_path)
+                spark.sql(f"ALTER TABLE delta.`{target_data_path}` SET TBLPROPERTIES ('fmd.pkBucketLength' = '{pk_bucket_length}')")
+            else:
+                dfDataChanged.write.format("delta").mode("overwrite").save(target_data_path)
+            record_metric("DeltaOperation", get_delta_operation_metrics(target_data_path, ("WRITE", "CREATE TABLE AS SELECT"), 5))
+            TotalRuntime = str((datetime.now() - start_audit_time))
+            end_audit_time =  str(datetime.now())
+            start_audit_time =str(start_audit_time)
+            # Your data
+            result_data = {
+                "Action" : "End", "CopyOutput":{
+                    "Total Runtime": TotalRuntime,
+                    "TargetSchema": TargetSchema,
+                    "TargetName" : TargetName,
+                    "SourceFilePath" : SourceFilePath,
+                    "SourceFileName" : SourceFileName,
+                    "SourceRowCount" : source_row_count,
+                    "CoalescedFiles" : len(source_files),
+                    "SupersededFiles" : len(superseded_files),
+                    "LandingzoneEntityId" : LandingzoneEntityId,
+                    "EntityId" : BronzeLayerEntityId,
+                    "StartTime" : start_audit_time,
+                    "EndTime" : end_audit_time
+
+                },
+                "DataQuality": dq_summary(dq_results),
+                "Instrumentation": get_instrumentation()
+                }
+
+            queue_landing_files_processed(superseded_files + source_files)
+            queue_sql_call(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="False", BronzeLayerEntityId=BronzeLayerEntityId)
+            queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
+            return result_data
+
+        #merge table
+        merge_condition = 'original.HashedPKColumn == updates.HashedPKColumn'
+        if pk_bucket_length:
+            # Matching on the partition column lets Delta skip the files of other buckets
+            merge_condition = f'original.HashedPKBucket == updates.HashedPKBucket AND {merge_condition}'
+
+        deltaTable = DeltaTable.forPath(spark, f'{target_data_path}')
+        target_version_before_merge = deltaTable.history(1).select("version").first()[0]
+        if IsIncremental in [False, 'false', 'False']:
+            # Deletes can hit every bucket, so a full load cannot be restricted to the buckets in the source
+            print(' - Incremental Loading is not enabled, deletes are allowed')
+            merge = deltaTable.alias('original') \
+                .merge(dfDataChanged.alias('updates'), merge_condition) \
+                .whenNotMatchedInsertAll() \
+                .whenMatchedUpdateAll('original.HashedNonKeyColumns != updates.HashedNonKeyColumns') \
+                .whenNotMatchedBySourceDelete() \
+                .execute()
+        else:
+            print(' - Incremental Loading is enabled, deletes are not allowed')
+            # Probe the target on its two hash columns only: new keys are appended, only keys whose
+            # content changed go through a merge, and a batch of pure inserts never rewrites a file.
+            target_index = dfDataOriginal
+            if pk_bucket_length:
+                # Name the buckets present in the source explicitly so only their partitions are scanned and rewritten
+                touched_buckets = [row[0] for row in dfDataChanged.select("HashedPKBucket").distinct().collect()]
+                target_index = target_index.where(col("HashedPKBucket").isin(touched_buckets))
+                if touched_buckets:
+                    bucket_list = ", ".join(f"'{bucket}'" for bucket in touched_buckets)
+                    merge_condition = f'original.HashedPKBucket IN ({bucket_list}) AND {merge_condition}'
+            target_index = target_index.select("HashedPKColumn", col("HashedNonKeyColumns").alias("TargetHashedNonKeyColumns"))
+
+            dfProbe = (dfDataChanged
+                       .join(target_index, "HashedPKColumn", "left")
+                       .withColumn("LoadAction",
+                                   when(col("TargetHashedNonKeyColumns").isNull(), lit("I"))
+                                   .when(col("TargetHashedNonKeyColumns") != col("HashedNonKeyColumns"), lit("U")))
+                       .select(*dfDataChanged.columns, "LoadAction")
+                       .persist(StorageLevel.MEMORY_AND_DISK))
+            probe_counts = dfProbe.agg(
+                sum_values(when(col("LoadAction") == "I", 1).otherwise(0)).alias("Inserts"),
+                sum_values(when(col("LoadAction") == "U", 1).otherwise(0)).alias("Updates")
+            ).collect()[0]
+            insert_count, update_count = probe_counts["Inserts"] or 0, probe_counts["Updates"] or 0
+            print(f' - {insert_count} new key(s) appended, {update_count} changed key(s) merged')
+            record_metric("RowsAppended", insert_count)
+            record_metric("RowsMerged", update_count)
+
+            try:
+                # Merge before append: a rerun after a failed append sees the appended keys as unchanged
+                if update_count:
+                    merge = deltaTable.alias('original') \
+                        .merge(dfProbe.where(col("LoadAction") == "U").drop("LoadAction").alias('updates'), merge_condition) \
+                        .whenMatchedUpdateAll() \
+                        .execute()
+                if insert_count:
+                    dfProbe.where(col("LoadAction") == "I").drop("LoadAction") \
+                        .write.format("delta").mode("append").save(target_data_path)
+            finally:
+                dfProbe.unpersist()
+
+        # Define Results
+        merge_metrics = get_merge_metrics(target_data_path, since_version=target_version_before_merge)
+        print(f"Merge metrics: {merge_metrics}")
+
+        TotalRuntime = str((datetime.now() - start_audit_time))
+        end_audit_time =  str(datetime.now())
+        start_audit_time =str(start_audit_time)
+        # Your data
+        result_data = {
+            "Action" : "End", "CopyOutput":{
+                "Total Runtime": TotalRuntime,
+                "TargetSchema": TargetSchema,
+                "TargetName" : TargetName,
+                "SourceFilePath" : SourceFilePath,
+                "SourceFileName" : SourceFileName,
+                "SourceRowCount" : source_row_count,
+                "CoalescedFiles" : len(source_files),
+                "SupersededFiles" : len(superseded_files),
+                "LandingzoneEntityId" : LandingzoneEntityId,
+                "EntityId" : BronzeLayerEntityId,
+                "StartTime" : start_audit_time,
+                "EndTime" : end_audit_time,
+                **merge_metrics
+
+            },
+            "DataQuality": dq_summary(dq_results),
+            "Instrumentation": get_instrumentation()
+            }
+
+        # Logging and update queue
+        queue_landing_files_processed(superseded_files + source_files)
+        queue_sql_call(SP_UPSERT_BRONZE_ENTITY, driver, connstring, database, SchemaName=TargetSchema, TableName=TargetName, IsProcessed="False", BronzeLayerEntityId=BronzeLayerEntityId)
+        queue_sql_call(SP_AUDIT_NOTEBOOK, driver, connstring, database, **audit_params, LogData=fit_log_data(result_data), LogType="EndNotebookActivity")
+        return result_data
+    finally:
+        dfSourceCached.unpersist()
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
@@ -29,6 +29,15 @@
 # - **Sequential Ordering**: Processes files within the same group sequentially based on filename timestamps
 # - **Batch Management**: Automatically creates execution batches while ensuring grouped items stay together
 # - **Dependency Handling**: Maintains execution dependencies within file groups
+# - **Single DAG**: With `SchedulingMode = "dag"` all activities form one DAG that runs with a rolling concurrency cap (`MaxConcurrency`)
+# - **Entity Dependencies**: In the single DAG, `EntityDependencies` chains whole entities (e.g. dimensions before facts); activities on the critical path are started first
+# - **In-Process Loading**: With `SchedulingMode = "inprocess"` Landing -> Bronze loads run as `load_landing_to_bronze` calls on a thread pool inside this session, sharing the SparkSession, connection pool and cleansing registry instead of starting a notebook per file
+# - **Adaptive Scheduling**: With `SchedulingMode = "adaptive"` each file group runs as its own unit, longest expected runtime first (from the audit log), and a slot is refilled as soon as a unit finishes
+# - **Adaptive Timeouts**: With `AdaptiveTimeouts = True` cell and DAG timeouts follow the p95 runtime of each entity and the size of its landing files, so hung jobs fail fast and large loads get the time they need
+# - **Priority Lanes**: `PriorityLanes` sorts entities into lanes (e.g. SLA-critical, large, small); in the single DAG each lane has reserved slots, so a flood of small tables cannot starve the critical ones
+# - **File Coalescing**: With `CoalesceFiles = True` all pending landing files of one entity are loaded into Bronze in a single run and merge; full-load entities load only the newest file and the older ones are marked processed
+# - **Retry Policy**: `RetryPolicy` sets retries with exponential backoff and jitter per entity class; retryable failures (throttling, capacity, timeouts) are re-queued into trailing batches
+# - **Resumable Runs**: Every finished activity is written to a run manifest in the lakehouse; with `ResumeRun = True` a rerun of the same `PipelineRunGuid` skips what already succeeded
 # - **Auto-Discovery**: Automatically creates the custom DQ cleansing notebook if it doesn't exist
 # 
 # ## Parameters
@@ -41,8 +50,14 @@ import re
 from datetime import datetime, timezone
 from collections import defaultdict
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import heapq
+import random
+import time
+from statistics import median
 
 NotebookExecutionId = str(uuid.uuid4())
+config_settings=notebookutils.variableLibrary.getLibrary("VAR_CONFIG_FMD")
 
 
 
@@ -67,8 +82,50 @@ TriggerType = ""
 notebook_entities = ""
 
 
+# Scheduling: 'batch' = runMultiple batches of 50 in appearance order,
+# 'adaptive' = file groups as units, longest expected runtime first, slots refilled continuously,
+# 'dag' = one DAG of all activities, at most MaxConcurrency running, started as their dependencies finish,
+# 'inprocess' = Landing -> Bronze file groups run as functions inside this Spark session (InProcessConcurrency threads),
+# without a notebook session per file; all other activities run as in 'dag'
+SchedulingMode = "batch"
+MaxConcurrency = 50
+InProcessConcurrency = 8
+# 'dag' only: entities that must finish before another starts, as JSON
+# {"<TargetSchema>.<TargetName>": ["<TargetSchema>.<TargetName>", ...]}, e.g. dimensions before a fact
+EntityDependencies = ""
+# Priority lanes, highest priority first, as JSON {"<lane>": {"slots": N, "entities": ["<TargetSchema>.<TargetName>", ...], "min_seconds": S}}.
+# An item joins the first lane that lists its entity, whose min_seconds its estimated runtime reaches,
+# or that its PriorityLane parameter names; everything else runs in the 'default' lane.
+# 'dag': each lane keeps `slots` of MaxConcurrency for itself, the rest is shared; the slots must leave at least one
+# slot for the lanes without slots, such as 'default'. Other modes: lanes only set the order.
+PriorityLanes = ""
+# Retry policy per entity class (lane name, 'Bronze'/'Silver' or 'default') as JSON, e.g.
+# {"default": {"retry": 2, "interval_seconds": 30, "backoff": 2.0, "max_interval_seconds": 600, "jitter": 0.25, "trailing_retries": 2}}
+# 'retry' and a jittered 'interval_seconds' go to runMultiple; failures classified as retryable are run again
+# in up to 'trailing_retries' trailing batches, each after an exponentially longer, jittered wait
+RetryPolicy = ""
+# Resume: skip the activities that already succeeded in an earlier attempt of this PipelineRunGuid
+ResumeRun = False
+# Run manifest file; empty = Files/_fmd_run_manifest/<PipelineRunGuid>.json in the target lakehouse of the first item
+RunManifestPath = ""
+# Load the backlog of landing files of one entity in a single Landing -> Bronze run (newest row per key wins)
+CoalesceFiles = False
+# Runtime estimates: the last RuntimeHistoryRuns End events per entity within RuntimeHistoryDays
+RuntimeHistoryRuns = 10
+RuntimeHistoryDays = 30
+# Timeouts: per activity TimeoutP95Factor x the p95 of its recent runtimes, or TimeoutSecondsPerGB x the size
+# of its landing files, whichever is larger, within [TimeoutMinSeconds, TimeoutMaxSeconds]; off = 600s per cell.
+# Without enough runtime history an activity keeps at least the 600s.
+AdaptiveTimeouts = False
+TimeoutP95Factor = 3.0
+TimeoutSecondsPerGB = 900
+TimeoutMinSeconds = 180
+TimeoutMaxSeconds = 14400
+
 ###############################Logging Parameters###############################
 driver = '{ODBC Driver 18 for SQL Server}'
+connstring=config_settings.fmd_fabric_db_connection
+database=config_settings.fmd_fabric_db_name
 
 
 # METADATA ********************
@@ -112,9 +169,9 @@ def is_valid_guid(guid_str: str) -> bool:
 
 def extract_ts_from_name(name: str) -> datetime:
     """
-    Extracts YYYYMMDDHHMM from names like 'Sales_Invoices_202601311402.parquet'
+    Extracts YYYYMMDDHHMM from names like 'Sales_Invoices_202601311402.parquet' or 'Sales_Invoices_202601311402.csv.gz'
     """
-    match = re.search(r'_(\d{12})(?=\.parquet$)', name)
+    match = re.search(r'_(\d{12})(?=(?:\.[^.]+)+$)', name)
     if not match:
         raise ValueError(f"Invalid filename timestamp: {name}")
     return datetime.strptime(match.group(1), "%Y%m%d%H%M")
@@ -132,6 +189,116 @@ def group_key(item):
         p.get("TargetName")
     )
 
+DEFAULT_RETRY_POLICY = {"retry": 2, "interval_seconds": 30, "backoff": 2.0, "max_interval_seconds": 600, "jitter": 0.25, "trailing_retries": 1}
+
+# Failures worth another attempt; anything else (bad data, missing tables, code errors) is fatal
+RETRYABLE_ERROR_PATTERNS = [
+    r"429", r"too\s*many\s*requests", r"throttl", r"capacity", r"\b50[234]\b", r"service\s*unavailable",
+    r"temporar(il)?y", r"timed?\s*out", r"timeout", r"connection\s*(reset|refused|aborted|closed)",
+    r"deadlock", r"livy", r"session.*(dead|killed|expired|not\s*found)", r"concurrentappendexception", r"concurrentmodification"
+]
+FATAL_ERROR_PATTERNS = [r"duplicated rows", r"doesn't exist", r"cannot resolve", r"data quality", r"syntaxerror", r"dependency cycle"]
+
+# Activities built in this run by name, with the item they run, for the trailing retry batches
+_BUILT_ACTIVITIES = {}
+
+# Notebook whose items SchedulingMode 'inprocess' runs as load_landing_to_bronze calls
+INPROCESS_NOTEBOOK = "NB_FMD_LOAD_LANDING_BRONZE"
+
+DEFAULT_CELL_TIMEOUT_SECONDS = 600
+DEFAULT_DAG_TIMEOUT_SECONDS = 7200
+
+def retry_policy_for(nb):
+    """Retry policy of the item's lane, else of its entity layer, else the default one."""
+    layer = (entity_key(nb) or (None,))[0]
+    for entity_class in (nb.get("lane"), layer, DEFAULT_LANE):
+        if entity_class in retry_policies:
+            return {**DEFAULT_RETRY_POLICY, **retry_policies[entity_class]}
+    return DEFAULT_RETRY_POLICY
+
+def jittered(seconds, jitter):
+    """`seconds` spread by +/- `jitter` so retries of many activities do not collide again."""
+    return max(0.0, seconds * random.uniform(1 - jitter, 1 + jitter))
+
+def classify_failure(exception) -> str:
+    """'retryable' or 'fatal' for the exception text of a runMultiple result."""
+    text = str(exception).lower()
+    if any(re.search(pattern, text) for pattern in FATAL_ERROR_PATTERNS):
+        return "fatal"
+    if any(re.search(pattern, text) for pattern in RETRYABLE_ERROR_PATTERNS):
+        return "retryable"
+    return "fatal"
+
+def build_activity(nb, activity_name, dependencies=None):
+    """runMultiple activity for one notebook item."""
+    policy = retry_policy_for(nb)
+    activity = {
+        "name": activity_name,
+        "path": nb["notebook_path"],
+        "timeoutPerCellInSeconds": nb.get("timeout_seconds", DEFAULT_CELL_TIMEOUT_SECONDS),
+        "args": nb["params"],
+        "retry": int(policy["retry"]),
+        "retryIntervalInSeconds": round(jittered(float(policy["interval_seconds"]), float(policy["jitter"])))
+    }
+    if dependencies:
+        activity["dependencies"] = dependencies
+    _BUILT_ACTIVITIES[activity_name] = (activity, nb)
+    return activity
+
+def entity_name_matches(name: str, key) -> bool:
+    """True if 'Schema.Table' or 'Namespace.Schema.Table' names the group key (namespace, schema, table)."""
+    parts = [part.strip().lower() for part in name.split(".")]
+    target = [str(value or "").lower() for value in key]
+    return parts == target[-len(parts):] if len(parts) in (2, 3) else False
+
+def critical_path_priority(activities, estimates):
+    """Priority per activity: minus the longest estimated runtime from its start to the end of the DAG.
+
+    Activities whose chain of dependents takes longest get the lowest value, so they start first.
+    """
+    dependents = defaultdict(list)
+    waiting = {}
+    for a in activities:
+        waiting[a["name"]] = len(a.get("dependencies", []))
+        for dependency in a.get("dependencies", []):
+            dependents[dependency].append(a["name"])
+
+    # Topological order, then longest remaining path from the end of the DAG backwards
+    order = [name for name, count in waiting.items() if count == 0]
+    for name in order:
+        for child in dependents[name]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                order.append(child)
+    if len(order) < len(activities):
+        cycle = sorted(name for name, count in waiting.items() if count > 0)
+        raise ValueError(f"Dependency cycle between activities: {cycle}")
+
+    remaining = {}
+    for name in reversed(order):
+        remaining[name] = estimates[name] + max((remaining[child] for child in dependents[name]), default=0.0)
+    return {name: -length for name, length in remaining.items()}
+
+DEFAULT_LANE = "default"
+
+def assign_lane(item, lanes, estimated_seconds) -> str:
+    """Name of the first lane in `lanes` the item belongs to, DEFAULT_LANE if none."""
+    requested = item["params"].get("PriorityLane")
+    for lane, settings in lanes.items():
+        if requested and requested.lower() == lane.lower():
+            return lane
+        if any(entity_name_matches(name, group_key(item)) for name in settings.get("entities", [])):
+            return lane
+        if "min_seconds" in settings and estimated_seconds >= float(settings["min_seconds"]):
+            return lane
+    return DEFAULT_LANE
+
+def dag_timeout(activities) -> int:
+    """DAG timeout: the longest dependency chain of cell timeouts, at least DEFAULT_DAG_TIMEOUT_SECONDS."""
+    timeouts = {a["name"]: float(a.get("timeoutPerCellInSeconds", DEFAULT_CELL_TIMEOUT_SECONDS)) for a in activities}
+    longest_chain = -min(critical_path_priority(activities, timeouts).values(), default=0.0)
+    return int(max(DEFAULT_DAG_TIMEOUT_SECONDS, longest_chain))
+
 def batched(lst, first_size, default_size):
     """Yield first batch with 'first_size', then others with 'default_size'."""
     if not lst:
@@ -241,6 +408,13 @@ if not nb_exists:
     #    for column in columns: # apply function foreach column
     #        df = df.<custom logic>
     #    return df #always return dataframe.
+    #register_cleansing_function("<functienaam>", <functienaam>)
+
+    # Vectorized functions get a pandas Series per column and run as pandas UDFs
+
+    #def <functienaam> (series, args):
+    #    return series.<custom logic> # return a Series of the same length
+    #register_vectorized_cleansing_function("<functienaam>", <functienaam>)
     """
 
     notebook_json = {
@@ -300,6 +474,151 @@ if not nb_exists:
 # META   "language_group": "synapse_pyspark"
 # META }
 
+# CELL ********************
+
+%run NB_FMD_UTILITY_FUNCTIONS
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+%run NB_FMD_DQ_CLEANSING
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+%run NB_FMD_LOAD_LANDING_BRONZE_FUNCTIONS
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# MARKDOWN ********************
+
+# ## Runtime estimates
+# Historic runtimes per entity come from the "Total Runtime" of the EndNotebookActivity events in the audit log.
+
+# CELL ********************
+
+NOTEBOOK_ENTITY_LAYERS = {"NB_FMD_LOAD_LANDING_BRONZE": "Bronze", "NB_FMD_LOAD_BRONZE_SILVER": "Silver"}
+DEFAULT_RUNTIME_SECONDS = 60.0
+
+RUNTIME_HISTORY_QUERY = """
+WITH runs AS (
+    SELECT EntityId, EntityLayer, LEFT(LogData, 1000) AS LogData,
+           ROW_NUMBER() OVER (PARTITION BY EntityLayer, EntityId ORDER BY LogDateTime DESC) AS RunNumber
+    FROM [logging].[NotebookExecution]
+    WHERE LogType = 'EndNotebookActivity'
+      AND EntityId IS NOT NULL
+      AND LogDateTime >= DATEADD(day, -?, GETDATE())
+)
+SELECT EntityId, EntityLayer, LogData FROM runs WHERE RunNumber <= ?
+"""
+
+def parse_runtime(value: str) -> float:
+    """Seconds in a str(timedelta) such as '0:01:02.500000' or '1 day, 0:00:05'."""
+    days = 0
+    if "day" in value:
+        day_part, value = value.split(",", 1)
+        days = int(day_part.split()[0])
+    hours, minutes, seconds = value.strip().split(":")
+    return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def entity_key(item):
+    """(EntityLayer, EntityId) under which the item's notebook writes its audit events, or None."""
+    p = item["params"]
+    layer = p.get("EntityLayer") or NOTEBOOK_ENTITY_LAYERS.get(item.get("path"))
+    entity_id = p.get("BronzeLayerEntityId") or p.get("EntityId")
+    if not layer or not entity_id:
+        return None
+    return (layer, str(entity_id).lower())
+
+def load_runtime_history(runs=RuntimeHistoryRuns, days=RuntimeHistoryDays):
+    """Recent runtimes in seconds per (EntityLayer, EntityId); empty when the audit log cannot be read."""
+    history = defaultdict(list)
+    try:
+        rows = execute_query(RUNTIME_HISTORY_QUERY, driver, connstring, database, int(days), int(runs))
+    except Exception as e:
+        print(f"WARNING: runtime history unavailable, using default estimates: {e}")
+        return history
+    for row in rows:
+        match = re.search(r'"Total Runtime"\s*:\s*"([^"]+)"', row["LogData"] or "")
+        if match:
+            try:
+                history[(row["EntityLayer"], str(row["EntityId"]).lower())].append(parse_runtime(match.group(1)))
+            except ValueError:
+                continue
+    return history
+
+def estimate_runtime(item, history) -> float:
+    """Median of the recent runtimes of the item's entity, or DEFAULT_RUNTIME_SECONDS without history."""
+    samples = history.get(entity_key(item))
+    return median(samples) if samples else DEFAULT_RUNTIME_SECONDS
+
+# A p95 needs a few runs to mean anything
+MIN_RUNTIME_SAMPLES_FOR_P95 = 3
+_LANDING_FOLDER_SIZES = {}
+
+def runtime_p95(item, history):
+    """95th percentile (nearest rank) of the recent runtimes of the item's entity, or None."""
+    samples = sorted(history.get(entity_key(item), []))
+    if len(samples) < MIN_RUNTIME_SAMPLES_FOR_P95:
+        return None
+    return samples[min(len(samples) - 1, int(0.95 * len(samples) + 0.999999) - 1)]
+
+def landing_file_bytes(item):
+    """Total size of the landing files a Landing -> Bronze item reads, 0 if unknown."""
+    p = item["params"]
+    if not p.get("SourceWorkspace") or not p.get("SourceLakehouse"):
+        return 0
+    files = loads(p["SourceFiles"]) if p.get("SourceFiles") else [{"SourceFilePath": p.get("SourceFilePath"), "SourceFileName": p.get("SourceFileName")}]
+    total = 0
+    for source_file in files:
+        if not source_file.get("SourceFileName"):
+            continue
+        folder = f"abfss://{p['SourceWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['SourceLakehouse']}/Files/{source_file['SourceFilePath']}"
+        # One listing per folder instead of one call per file
+        if folder not in _LANDING_FOLDER_SIZES:
+            try:
+                _LANDING_FOLDER_SIZES[folder] = {f.name: f.size for f in notebookutils.fs.ls(folder)}
+            except Exception as e:
+                print(f"WARNING: landing folder {folder} not listed: {e}")
+                _LANDING_FOLDER_SIZES[folder] = {}
+        total += _LANDING_FOLDER_SIZES[folder].get(source_file["SourceFileName"], 0)
+    return total
+
+def activity_timeout(item, history) -> int:
+    """Cell timeout for the item from its p95 runtime and landing file size.
+    Without a p95 the timeout is never below DEFAULT_CELL_TIMEOUT_SECONDS: the file size alone does not show how slow an entity is."""
+    p95 = runtime_p95(item, history)
+    size_bytes = landing_file_bytes(item) if item.get("notebook_path") == "NB_FMD_LOAD_LANDING_BRONZE" else 0
+    if p95 is None and not size_bytes:
+        return DEFAULT_CELL_TIMEOUT_SECONDS
+    timeout = max((p95 or 0) * float(TimeoutP95Factor), size_bytes / 1024 ** 3 * float(TimeoutSecondsPerGB))
+    floor = float(TimeoutMinSeconds) if p95 is not None else max(float(TimeoutMinSeconds), DEFAULT_CELL_TIMEOUT_SECONDS)
+    return int(min(float(TimeoutMaxSeconds), max(floor, timeout)))
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
 # MARKDOWN ********************
 
 # ## Define Notebooks settings
@@ -387,10 +706,25 @@ def safe_sort_key(pair):
 
 
 largest_group_size = 1
+coalesced_indices = set()
 
 for g, entries in list(groups.items()):
     sorted_entries = sorted(entries, key=safe_sort_key)
 
+    # One Bronze run for the whole backlog: the newest item carries all files in timestamp order.
+    # Incremental entities merge them all; a full load only reads the newest snapshot (a key deleted
+    # there must not come back from an older file) and marks the older files processed.
+    if CoalesceFiles and len(sorted_entries) > 1 and all(item["notebook_path"] == "NB_FMD_LOAD_LANDING_BRONZE" for _, item in sorted_entries):
+        latest_idx, latest_item = sorted_entries[-1]
+        latest_item["params"]["SourceFiles"] = dumps([
+            {"SourceFilePath": item["params"].get("SourceFilePath"), "SourceFileName": item["params"].get("SourceFileName")}
+            for _, item in sorted_entries
+        ])
+        coalesced_indices.update(orig_idx for orig_idx, _ in sorted_entries[:-1])
+        incremental = latest_item["params"].get("IsIncremental") not in (False, "false", "False", None, "")
+        print(f"{'Coalesced' if incremental else 'Superseded by the newest of'} {len(sorted_entries)} files in one load: {latest_item['params'].get('TargetSchema')}.{latest_item['params'].get('TargetName')}")
+        sorted_entries = [(latest_idx, latest_item)]
+
     for order_idx, (orig_idx, item) in enumerate(sorted_entries):
         item["is_grouped_job"] = True
         item["order_index"] = order_idx
@@ -401,7 +735,7 @@ for g, entries in list(groups.items()):
 # Build a notebooks list that keeps groups intact
 # Strategy: place grouped items contiguously, preserving their internal order.
 # You can choose the order of groups; here we keep original appearance order.
-seen_indices = set()
+seen_indices = set(coalesced_indices)
 ordered_notebooks = []
 for idx, it in enumerate(path_data):
     if idx in seen_indices:
@@ -418,6 +752,29 @@ for idx, it in enumerate(path_data):
     if idx not in seen_indices:
         ordered_notebooks.append(it)
 
+# Priority lanes: higher lanes come first in every scheduling mode, in the single DAG they also get reserved slots
+priority_lanes = loads(PriorityLanes) if PriorityLanes else {}
+lane_rank = {lane: rank for rank, lane in enumerate(priority_lanes)}
+lane_rank.setdefault(DEFAULT_LANE, len(lane_rank))
+lane_slots = {lane: int(settings.get("slots", 0)) for lane, settings in priority_lanes.items()}
+retry_policies = loads(RetryPolicy) if RetryPolicy else {}
+needs_history = SchedulingMode != "batch" or AdaptiveTimeouts or any("min_seconds" in settings for settings in priority_lanes.values())
+runtime_history = load_runtime_history() if needs_history else {}
+for it in path_data:
+    it["lane"] = assign_lane(it, priority_lanes, estimate_runtime(it, runtime_history))
+    if AdaptiveTimeouts:
+        it["timeout_seconds"] = activity_timeout(it, runtime_history)
+if AdaptiveTimeouts and path_data:
+    timeouts = sorted(it["timeout_seconds"] for it in path_data)
+    print(f"Adaptive timeouts: {timeouts[0]}s - {timeouts[-1]}s per cell, median {median(timeouts):.0f}s")
+if priority_lanes:
+    # Stable sort: groups stay contiguous and keep their appearance order within a lane
+    ordered_notebooks.sort(key=lambda nb: lane_rank[nb["lane"]])
+    lane_sizes = defaultdict(int)
+    for nb in ordered_notebooks:
+        lane_sizes[nb["lane"]] += 1
+    print("Priority lanes: " + ", ".join(f"{lane}={lane_sizes[lane]} (slots {priority_lanes.get(lane, {}).get('slots', 0)})" for lane in lane_rank))
+
 # Batching with guarantee: no group split across batches
 # Cap batches at 50 (runMultiple limit) while ensuring largest group fits in one batch
 max_concurrent_notebooks = 50
@@ -425,21 +782,18 @@ if largest_group_size > max_concurrent_notebooks:
     print(f"WARNING: largest group has {largest_group_size} items, exceeds runMultiple limit of {max_concurrent_notebooks}")
 first_batch_size = min(max_concurrent_notebooks, max(max_concurrent_notebooks, largest_group_size))
 
-for n, batch in enumerate(batched(ordered_notebooks, first_batch_size, max_concurrent_notebooks)):
+if SchedulingMode not in ("batch", "adaptive", "dag", "inprocess"):
+    raise ValueError(f"Unknown SchedulingMode '{SchedulingMode}', expected 'batch', 'adaptive', 'dag' or 'inprocess'")
+batch_notebooks = ordered_notebooks if SchedulingMode == "batch" else []
+
+for n, batch in enumerate(batched(batch_notebooks, first_batch_size, max_concurrent_notebooks)):
     activities = []
     # Track last activity name per group to wire dependsOn inside that group
     last_activity_name_by_group = {}
 
     for i, nb in enumerate(batch):
         activity_name = f"{nb['notebook_activity_id']}_{n}_{i}"
-        activity = {
-            "name": activity_name,
-            "path": nb["notebook_path"],
-            "timeoutPerCellInSeconds": 600,
-            "args": nb["params"],
-            "retry": 2,
-            "retryIntervalInSeconds": 0
-        }
+        activity = build_activity(nb, activity_name)
 
         if nb.get("is_grouped_job"):
             g = group_key(nb)
@@ -451,15 +805,85 @@ for n, batch in enumerate(batched(ordered_notebooks, first_batch_size, max_concu
 
         activities.append(activity)
 
+    # Critical path first: runMultiple starts ready activities in list order
+    batch_estimates = {activity["name"]: estimate_runtime(nb, runtime_history) for nb, activity in zip(batch, activities)}
+    batch_priority = critical_path_priority(activities, batch_estimates)
+    batch_lanes = {activity["name"]: nb["lane"] for nb, activity in zip(batch, activities)}
+    activities.sort(key=lambda activity: (lane_rank[batch_lanes[activity["name"]]], batch_priority[activity["name"]]))
+
     cmd_dag = {
         "activities": activities,
-        "timeoutInSeconds": 7200,
+        "timeoutInSeconds": dag_timeout(activities),
         "concurrency": len(activities)  # Allow concurrent execution; in-group dependencies enforced by dependsOn
     }
     cmd_dags.append(cmd_dag)
     print(f"Batch {n + 1}: {len(activities)} activities created")
 
-print(f"\nTotal batches: {len(cmd_dags)} (runMultiple limit: 50 per batch)")
+if cmd_dags:
+    print(f"\nTotal batches: {len(cmd_dags)} (runMultiple limit: 50 per batch)")
+
+# Adaptive scheduling: every file group is a unit whose files run in timestamp order.
+# Units are started longest expected runtime first (LPT) and a new unit starts as soon as
+# one finishes, so a slow table no longer holds back the rest of its batch.
+# In-process loading uses the same units for the Landing -> Bronze file groups.
+inprocess_groups = set()
+if SchedulingMode == "inprocess":
+    inprocess_groups = {g for g, entries in groups.items() if all(item["notebook_path"] == INPROCESS_NOTEBOOK for _, item in entries)}
+units = []
+if SchedulingMode in ("adaptive", "inprocess"):
+    for u, (g, entries) in enumerate(groups.items()):
+        if SchedulingMode == "inprocess" and g not in inprocess_groups:
+            continue
+        unit_items = [item for _, item in entries]
+        units.append({
+            "index": u,
+            "items": unit_items,
+            "lane": unit_items[0]["lane"],
+            "estimated_seconds": sum(estimate_runtime(item, runtime_history) for item in unit_items)
+        })
+    units.sort(key=lambda unit: (lane_rank[unit["lane"]], -unit["estimated_seconds"]))
+    known = sum(1 for it in path_data if entity_key(it) in runtime_history)
+    slots = InProcessConcurrency if SchedulingMode == "inprocess" else MaxConcurrency
+    print(f"{SchedulingMode.capitalize()} scheduling: {len(units)} units, runtime history for {known}/{len(path_data)} activities, "
+          f"estimated total {sum(unit['estimated_seconds'] for unit in units):.0f}s over {slots} slots")
+
+# Single DAG: one activity per item, chained within its file group.
+dag_activities = []
+if SchedulingMode in ("dag", "inprocess"):
+    dag_notebooks = [nb for nb in ordered_notebooks if group_key(nb) not in inprocess_groups]
+    last_activity_name_by_group = {}
+    for i, nb in enumerate(dag_notebooks):
+        g = group_key(nb)
+        prev = last_activity_name_by_group.get(g)
+        activity = build_activity(nb, f"{nb['notebook_activity_id']}_{i}", [prev] if prev else None)
+        last_activity_name_by_group[g] = activity["name"]
+        dag_activities.append(activity)
+
+    # Entity dependencies: the first file of an entity waits for the last file of each entity it depends on
+    entity_dependencies = loads(EntityDependencies) if EntityDependencies else {}
+    first_activity_by_group = {}
+    for nb, activity in zip(dag_notebooks, dag_activities):
+        first_activity_by_group.setdefault(group_key(nb), activity)
+    for entity, required in entity_dependencies.items():
+        dependent_groups = [g for g in first_activity_by_group if entity_name_matches(entity, g)]
+        required_groups = [g for name in required for g in last_activity_name_by_group if entity_name_matches(name, g)]
+        if not dependent_groups or not required_groups:
+            print(f"Dependency {entity} <- {required} ignored: entity not in this run")
+            continue
+        for g in dependent_groups:
+            activity = first_activity_by_group[g]
+            activity["dependencies"] = list(dict.fromkeys(
+                activity.get("dependencies", []) + [last_activity_name_by_group[r] for r in required_groups if r != g]))
+
+    # Critical path first: estimated runtimes from the audit log
+    estimates = {activity["name"]: estimate_runtime(nb, runtime_history) for nb, activity in zip(dag_notebooks, dag_activities)}
+    dag_priority = critical_path_priority(dag_activities, estimates)
+    dag_lanes = {activity["name"]: nb["lane"] for nb, activity in zip(dag_notebooks, dag_activities)}
+    dag_activities.sort(key=lambda activity: (lane_rank[dag_lanes[activity["name"]]], dag_priority[activity["name"]]))
+    print(f"Single DAG: {len(dag_activities)} activities, at most {MaxConcurrency} running, "
+          f"critical path {-min(dag_priority.values(), default=0):.0f}s estimated")
+elif EntityDependencies:
+    print("WARNING: EntityDependencies are only honoured with SchedulingMode 'dag'")
 
 
 # METADATA ********************
@@ -469,24 +893,372 @@ print(f"\nTotal batches: {len(cmd_dags)} (runMultiple limit: 50 per batch)")
 # META   "language_group": "synapse_pyspark"
 # META }
 
+# MARKDOWN ********************
+
+# ## Run manifest
+# Status, exit value and timings of every finished activity, keyed by activity name, so a rerun can resume.
+
 # CELL ********************
 
-# Execute Notebooks in batches (runMultiple max: 50 notebooks per call)
+RUN_MANIFEST_FOLDER = "_fmd_run_manifest"
+RUN_MANIFEST_MAX_BYTES = 10 * 1024 * 1024
+
+def run_manifest_path():
+    """RunManifestPath, or a file per PipelineRunGuid in the target lakehouse of the first item."""
+    if RunManifestPath:
+        return RunManifestPath
+    if not path_data or not PipelineRunGuid:
+        return None
+    p = path_data[0]["params"]
+    if not p.get("TargetWorkspace") or not p.get("TargetLakehouse"):
+        return None
+    return f"abfss://{p['TargetWorkspace']}@onelake.dfs.fabric.microsoft.com/{p['TargetLakehouse']}/Files/{RUN_MANIFEST_FOLDER}/{PipelineRunGuid}.json"
+
+def load_run_manifest(path):
+    """Manifest of an earlier attempt, or an empty one."""
+    empty = {"PipelineRunGuid": PipelineRunGuid, "Activities": {}}
+    if not path:
+        return empty
+    try:
+        if notebookutils.fs.exists(path):
+            return loads(notebookutils.fs.head(path, RUN_MANIFEST_MAX_BYTES))
+    except Exception as e:
+        print(f"WARNING: run manifest {path} unreadable, starting from scratch: {e}")
+    return empty
+
+def activity_identity(name):
+    """Manifest key of an activity: notebook, target table, entity and source file, not its positional name."""
+    if name not in _BUILT_ACTIVITIES:
+        return name
+    nb = _BUILT_ACTIVITIES[name][1]
+    p = nb["params"]
+    entity_id = p.get("BronzeLayerEntityId") or p.get("EntityId") or p.get("LandingzoneEntityId")
+    return "|".join(str(part or "").lower() for part in (
+        nb["notebook_path"], f"{p.get('TargetSchema') or ''}.{p.get('TargetName') or ''}", entity_id, p.get("SourceFileName")))
+
+def succeeded_earlier(name):
+    """Whether the activity succeeded in an earlier attempt of this run."""
+    return activity_identity(name) in succeeded_identities
+
+def record_run_results(activity_results, start_time, end_time=None):
+    """Add finished activities to the run manifest and write it back to the lakehouse."""
+    end_time = end_time or datetime.now()
+    for name, activity_result in activity_results.items():
+        run_manifest["Activities"][activity_identity(name)] = {
+            "ActivityName": name,
+            "Status": "Succeeded" if activity_result.get("exception") is None else "Failed",
+            "ExitVal": activity_result.get("exitVal"),
+            "Exception": None if activity_result.get("exception") is None else str(activity_result["exception"]),
+            "StartTime": str(start_time),
+            "EndTime": str(end_time),
+            "Attempt": run_attempt
+        }
+    if manifest_path:
+        try:
+            notebookutils.fs.put(manifest_path, dumps(run_manifest, default=str), True)
+        except Exception as e:
+            print(f"WARNING: run manifest {manifest_path} not written: {e}")
+
+def pending_activities(activities):
+    """Activities that did not succeed earlier, without their dependencies on ones that did."""
+    pending = []
+    for activity in activities:
+        if succeeded_earlier(activity["name"]):
+            continue
+        activity = dict(activity)
+        dependencies = [d for d in activity.get("dependencies", []) if not succeeded_earlier(d)]
+        if dependencies:
+            activity["dependencies"] = dependencies
+        else:
+            activity.pop("dependencies", None)
+        pending.append(activity)
+    return pending
+
+manifest_path = run_manifest_path()
+run_manifest = load_run_manifest(manifest_path) if ResumeRun else {"PipelineRunGuid": PipelineRunGuid, "Activities": {}}
+run_attempt = max((entry.get("Attempt", 1) for entry in run_manifest["Activities"].values()), default=0) + 1
+succeeded_identities = {identity for identity, entry in run_manifest["Activities"].items() if entry.get("Status") == "Succeeded"}
+if ResumeRun:
+    print(f"Resuming run {PipelineRunGuid} (attempt {run_attempt}): {len(succeeded_identities)} activities already succeeded")
+print(f"Run manifest: {manifest_path or 'not persisted'}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+def run_inprocess_unit(unit):
+    """Run the Landing -> Bronze loads of one unit in order, in this session, and return their results."""
+    unit_results = {}
+    failed = None
+    name = None
+    for i, nb in enumerate(unit["items"]):
+        # Registered like a notebook activity, so a retryable failure can go to a trailing retry batch
+        name = build_activity(nb, f"{nb['notebook_activity_id']}_{unit['index']}_{i}", [name] if name else None)["name"]
+        if succeeded_earlier(name):
+            continue
+        if failed:
+            unit_results[name] = {"exitVal": None, "exception": f"Skipped: dependency {failed} failed"}
+            continue
+        try:
+            result_data = load_landing_to_bronze({**nb["params"], "NotebookName": INPROCESS_NOTEBOOK})
+            unit_results[name] = {"exitVal": dumps(result_data, default=str), "exception": None}
+        except Exception as e:
+            # load_landing_to_bronze has queued its FailNotebookActivity audit
+            print(f"⚠ {name} failed: {e}")
+            unit_results[name] = {"exitVal": None, "exception": f"{type(e).__name__}: {e}"}
+            failed = name
+        # Flushes the calls of this thread only; a write that could not reach the database stays queued
+        try:
+            flush_sql_calls(driver, connstring, database)
+        except Exception as e:
+            print(f"WARNING: metadata writes after {name} not flushed yet: {e}")
+    return unit_results
+
+def run_unit(unit):
+    """Run one unit as a chained runMultiple DAG and return its results."""
+    activities = []
+    for i, nb in enumerate(unit["items"]):
+        dependencies = [activities[-1]["name"]] if activities else None
+        activities.append(build_activity(nb, f"{nb['notebook_activity_id']}_{unit['index']}_{i}", dependencies))
+    activities = pending_activities(activities)
+    if not activities:
+        return {}
+    cmd_dag = {"activities": activities, "timeoutInSeconds": dag_timeout(activities), "concurrency": 1}
+    try:
+        return notebookutils.mssparkutils.notebook.runMultiple(cmd_dag)
+    except notebookutils.mssparkutils.handlers.notebookHandler.RunMultipleFailedException as e:
+        print(f"⚠ Unit {unit['index']} had errors, continuing with partial results")
+        return e.result
+
+# runMultiple accepts at most this many activities; larger DAGs are driven by run_dag itself
+RUN_MULTIPLE_MAX_ACTIVITIES = 50
+
+def run_activity(activity):
+    """Run a single activity (its dependencies already finished) and return its result."""
+    activity = {key: value for key, value in activity.items() if key != "dependencies"}
+    try:
+        return notebookutils.mssparkutils.notebook.runMultiple({"activities": [activity], "timeoutInSeconds": dag_timeout([activity]), "concurrency": 1})
+    except notebookutils.mssparkutils.handlers.notebookHandler.RunMultipleFailedException as e:
+        return e.result
+
+def run_dag(activities, concurrency, priority=None, lanes=None, lane_slots=None, on_result=None):
+    """Run activities honouring their dependencies with at most `concurrency` running at once.
+
+    Up to RUN_MULTIPLE_MAX_ACTIVITIES activities go to runMultiple as one DAG, listed by priority. Larger DAGs, and DAGs
+    with reserved lane slots, run as a sliding window: whenever an activity finishes, the ready
+    activities with the lowest priority value (default: submission order) fill the free slots.
+    `lanes` maps activity name to lane and `lane_slots` lane to its reserved slots: a lane below its
+    reservation starts first, other activities share the slots nobody reserved; a lane reserves slots
+    only for its ready and running activities. Dependents of a failed activity are skipped. `on_result(results, start_time)` is called as activities finish.
+    """
+    concurrency = max(1, int(concurrency))
+    lanes = lanes or {}
+    lane_slots = {lane: slots for lane, slots in (lane_slots or {}).items() if slots > 0}
+    if sum(lane_slots.values()) > concurrency:
+        raise ValueError(f"Reserved lane slots {sum(lane_slots.values())} exceed the concurrency of {concurrency}")
+    unreserved_lanes = {lanes.get(a["name"], DEFAULT_LANE) for a in activities} - set(lane_slots)
+    if unreserved_lanes and sum(lane_slots.values()) >= concurrency:
+        raise ValueError(f"Reserved lane slots {sum(lane_slots.values())} leave no slot of the concurrency of {concurrency} "
+                         f"for lane(s) {sorted(unreserved_lanes)}")
+    if len(activities) <= RUN_MULTIPLE_MAX_ACTIVITIES and not lane_slots:
+        if not activities:
+            return {}
+        if priority is not None:
+            # runMultiple starts ready activities in list order: lanes as they come, by priority within a lane
+            lane_order = {lane: i for i, lane in enumerate(dict.fromkeys(lanes.get(a["name"], DEFAULT_LANE) for a in activities))}
+            activities = sorted(activities, key=lambda a: (lane_order[lanes.get(a["name"], DEFAULT_LANE)], priority[a["name"]]))
+        cmd_dag = {"activities": activities, "timeoutInSeconds": dag_timeout(activities), "concurrency": min(concurrency, len(activities))}
+        start_time = datetime.now()
+        try:
+            dag_results = notebookutils.mssparkutils.notebook.runMultiple(cmd_dag, {"displayDAGViaGraphviz": True})
+        except notebookutils.mssparkutils.handlers.notebookHandler.RunMultipleFailedException as e:
+            dag_results = e.result
+        if on_result:
+            on_result(dag_results, start_time)
+        return dag_results
+
+    if priority is None:
+        priority = {a["name"]: i for i, a in enumerate(activities)}
+    by_name = {a["name"]: a for a in activities}
+    dependents = defaultdict(list)
+    waiting = {}
+    for a in activities:
+        waiting[a["name"]] = len(a.get("dependencies", []))
+        for dependency in a.get("dependencies", []):
+            dependents[dependency].append(a["name"])
+    ready = defaultdict(list)
+    for name, count in waiting.items():
+        if count == 0:
+            heapq.heappush(ready[lanes.get(name, DEFAULT_LANE)], (priority[name], name))
+    running_by_lane = defaultdict(int)
+
+    def next_ready():
+        """Lane of the activity to start next, None if no ready activity may take a free slot."""
+        # A lane only holds on to the slots its ready and running activities can use, so activities
+        # still waiting on another lane do not keep that lane from running
+        reserved_slots = {lane: min(slots, len(ready[lane]) + running_by_lane[lane]) for lane, slots in lane_slots.items()}
+        shared_slots = concurrency - sum(reserved_slots.values())
+        overflow = sum(max(0, count - reserved_slots.get(lane, 0)) for lane, count in running_by_lane.items())
+        best = None
+        for lane, heap in ready.items():
+            if not heap:
+                continue
+            reserved = running_by_lane[lane] < reserved_slots.get(lane, 0)
+            if not reserved and overflow >= shared_slots:
+                continue
+            key = (not reserved, heap[0][0])
+            if best is None or key < best[0]:
+                best = (key, lane)
+        return best[1] if best else None
+
+    dag_results = {}
+
+    def skip_dependents(name):
+        failed = [name]
+        while failed:
+            parent = failed.pop()
+            for child in dependents[parent]:
+                if child not in dag_results:
+                    dag_results[child] = {"exitVal": None, "exception": f"Skipped: dependency {parent} failed"}
+                    failed.append(child)
+
+    running = {}
+    started = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while any(ready.values()) or running:
+            while len(running) < concurrency:
+                lane = next_ready()
+                if lane is None:
+                    break
+                _, name = heapq.heappop(ready[lane])
+                running_by_lane[lane] += 1
+                started[name] = datetime.now()
+                running[executor.submit(run_activity, by_name[name])] = name
+            if not running:
+                stuck = sorted(name for heap in ready.values() for _, name in heap)
+                raise RuntimeError(f"No activity can start and none is running, ready: {stuck}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                running_by_lane[lanes.get(name, DEFAULT_LANE)] -= 1
+                activity_result = future.result()
+                dag_results.update(activity_result)
+                if on_result:
+                    on_result(activity_result, started[name])
+                if activity_result.get(name, {}).get("exception") is not None:
+                    skip_dependents(name)
+                    continue
+                for child in dependents[name]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        heapq.heappush(ready[lanes.get(child, DEFAULT_LANE)], (priority[child], child))
+            print(f"DAG progress: {len(dag_results)}/{len(activities)} finished, {len(running)} running")
+    return dag_results
+
 results = {}
+if SchedulingMode == "inprocess" and units:
+    configure_bronze_session()
+    with ThreadPoolExecutor(max_workers=max(1, int(InProcessConcurrency))) as executor:
+        futures = {executor.submit(run_inprocess_unit, unit): datetime.now() for unit in units}
+        for future in as_completed(futures):
+            unit_results = future.result()
+            record_run_results(unit_results, futures[future])
+            results.update(unit_results)
+    try:
+        flush_all_sql_calls(driver, connstring, database)
+    except Exception as e:
+        print(f"WARNING: metadata writes of the in-process loads could not be flushed: {e}")
+
+if SchedulingMode in ("dag", "inprocess"):
+    results.update(run_dag(pending_activities(dag_activities), MaxConcurrency, dag_priority, dag_lanes, lane_slots, record_run_results))
+
+if SchedulingMode == "adaptive":
+    with ThreadPoolExecutor(max_workers=max(1, int(MaxConcurrency))) as executor:
+        futures = {executor.submit(run_unit, unit): datetime.now() for unit in units}
+        for future in as_completed(futures):
+            unit_results = future.result()
+            record_run_results(unit_results, futures[future])
+            results.update(unit_results)
+
+# Execute Notebooks in batches (runMultiple max: 50 notebooks per call)
 for batch_idx, cmd_dag in enumerate(cmd_dags):
+    cmd_dag = {**cmd_dag, "activities": pending_activities(cmd_dag["activities"])}
+    if not cmd_dag["activities"]:
+        print(f"\nSkipping batch {batch_idx + 1}/{len(cmd_dags)}: all activities succeeded earlier")
+        continue
+    cmd_dag["concurrency"] = len(cmd_dag["activities"])
+    batch_start_time = datetime.now()
+    batch_results = {}
     try:
         print(f"\nExecuting batch {batch_idx + 1}/{len(cmd_dags)} with {len(cmd_dag['activities'])} activities...")
         batch_results = notebookutils.mssparkutils.notebook.runMultiple(cmd_dag, {"displayDAGViaGraphviz": True})
-        results.update(batch_results)
         print(f"✓ Batch {batch_idx + 1} completed successfully")
     except notebookutils.mssparkutils.handlers.notebookHandler.RunMultipleFailedException as e:
         print(f"⚠ Batch {batch_idx + 1} had errors, continuing with partial results")
-        results.update(e.result)
+        batch_results = e.result
     except Exception as e:
+        # Whatever the batch reported is kept; activities without a result count as failed
+        batch_results = {activity["name"]: {"exitVal": None, "exception": f"Batch aborted: {type(e).__name__}: {e}"}
+                         for activity in cmd_dag["activities"]}
+        batch_results.update(getattr(e, "result", None) or {})
         print(f"\n✗ ERROR in batch {batch_idx + 1}:")
         print(f"  Activities: {len(cmd_dag['activities'])}")
         print(f"  Exception: {str(e)}")
+        print(f"  Rerun with ResumeRun = True and PipelineRunGuid = {PipelineRunGuid} to skip the {len(succeeded_identities) + sum(1 for r in {**results, **batch_results}.values() if r.get('exception') is None)} succeeded activities")
         raise
+    finally:
+        record_run_results(batch_results, batch_start_time)
+        results.update(batch_results)
+
+# Activities that succeeded in an earlier attempt keep their result without running again
+for name in _BUILT_ACTIVITIES:
+    if name not in results and succeeded_earlier(name):
+        results[name] = {"exitVal": run_manifest["Activities"][activity_identity(name)].get("ExitVal"), "exception": None}
+
+def retry_candidates(attempt):
+    """Failed activities to run again in trailing batch `attempt`, plus their skipped dependents."""
+    retry_names = [name for name, table_data in results.items()
+                   if table_data.get("exception") is not None and name in _BUILT_ACTIVITIES
+                   and attempt < int(retry_policy_for(_BUILT_ACTIVITIES[name][1])["trailing_retries"])
+                   and classify_failure(table_data["exception"]) == "retryable"]
+    # Dependents skipped only because of retryable failures come along, in their original order
+    selected = set(retry_names)
+    for name, (activity, _) in _BUILT_ACTIVITIES.items():
+        dependencies = activity.get("dependencies", [])
+        if name in results and str(results[name].get("exception", "")).startswith("Skipped: dependency") \
+                and any(d in selected for d in dependencies) \
+                and all(d in selected or results.get(d, {}).get("exception") is None for d in dependencies):
+            selected.add(name)
+    return [name for name in _BUILT_ACTIVITIES if name in selected]
+
+# Trailing retry batches: retryable failures run again after an exponential, jittered backoff
+for attempt in range(max([int(retry_policy_for(nb)["trailing_retries"]) for nb in path_data], default=0)):
+    retry_names = retry_candidates(attempt)
+    if not retry_names:
+        break
+    retry_set = set(retry_names)
+    retry_activities = []
+    for name in retry_names:
+        activity = {key: value for key, value in _BUILT_ACTIVITIES[name][0].items() if key != "dependencies"}
+        dependencies = [d for d in _BUILT_ACTIVITIES[name][0].get("dependencies", []) if d in retry_set]
+        if dependencies:
+            activity["dependencies"] = dependencies
+        retry_activities.append(activity)
+    policies = [retry_policy_for(_BUILT_ACTIVITIES[name][1]) for name in retry_names]
+    delay = max(jittered(min(float(policy["max_interval_seconds"]), float(policy["interval_seconds"]) * float(policy["backoff"]) ** (attempt + 1)),
+                         float(policy["jitter"])) for policy in policies)
+    print(f"\nRetry batch {attempt + 1}: {len(retry_activities)} activities after {delay:.0f}s backoff")
+    time.sleep(delay)
+    retry_lanes = {name: _BUILT_ACTIVITIES[name][1].get("lane", DEFAULT_LANE) for name in retry_names}
+    retry_priority = critical_path_priority(retry_activities, {name: estimate_runtime(_BUILT_ACTIVITIES[name][1], runtime_history) for name in retry_names})
+    retry_activities.sort(key=lambda activity: lane_rank[retry_lanes[activity["name"]]])
+    results.update(run_dag(retry_activities, MaxConcurrency, retry_priority, retry_lanes,
+                           lane_slots if SchedulingMode in ("dag", "inprocess") else None, record_run_results))
 
 # METADATA ********************
 
@@ -17,6 +17,153 @@
 # CELL ********************
 
 import struct, pyodbc
+import atexit, base64, json, queue, re, threading, time
+
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Connection pool for the framework database.
+# Tokens are cached until shortly before they expire and connections are kept open
+# between calls, so a notebook pays for the login once instead of on every
+# execute_with_outputs call. The pool survives a second %run of this notebook.
+SQL_TOKEN_RESOURCE = 'https://analysis.windows.net/powerbi/api'
+SQL_TOKEN_REFRESH_MARGIN_SECONDS = 300
+SQL_POOL_MAX_IDLE_CONNECTIONS = 4
+SQL_POOL_HEALTH_CHECK_IDLE_SECONDS = 60
+SQL_MAX_ATTEMPTS = 3
+SQL_RETRY_BACKOFF_SECONDS = 2
+
+# SQLSTATEs and SQL Server error numbers that indicate a dropped or throttled connection
+_TRANSIENT_SQLSTATES = {"08001", "08003", "08004", "08007", "08S01", "HYT00", "HYT01", "40001"}
+_TRANSIENT_ERROR_NUMBERS = {"233", "4060", "4221", "10053", "10054", "10060", "10928", "10929",
+                            "40143", "40197", "40501", "40613", "49918", "49919", "49920"}
+
+if "_CONNECTION_POOL" not in globals():
+    _CONNECTION_POOL = {}
+    _TOKEN_CACHE = {}
+    _CONNECTION_POOL_LOCK = threading.Lock()
+
+
+def _token_expiry(token):
+    """Return the 'exp' claim of a JWT access token as epoch seconds (None if unreadable)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+def get_sql_token_struct(resource=SQL_TOKEN_RESOURCE):
+    """Return the packed access token for pyodbc, fetching a new one only when the cached token is about to expire.
+
+    Returns:
+        tuple: (token_struct, expires_at epoch seconds)
+    """
+    with _CONNECTION_POOL_LOCK:
+        cached = _TOKEN_CACHE.get(resource)
+        if cached and cached[1] - SQL_TOKEN_REFRESH_MARGIN_SECONDS > time.time():
+            return cached
+
+    token = notebookutils.credentials.getToken(resource)
+    # Fall back to the shortest lifetime Entra ID hands out when the token cannot be decoded
+    expires_at = _token_expiry(token) or time.time() + 3600
+    encoded = token.encode("UTF-16-LE")
+    token_struct = struct.pack(f'<I{len(encoded)}s', len(encoded), encoded)
+
+    with _CONNECTION_POOL_LOCK:
+        _TOKEN_CACHE[resource] = (token_struct, expires_at)
+    return token_struct, expires_at
+
+
+def _open_connection(driver, connstring, database):
+    token_struct, expires_at = get_sql_token_struct()
+    conn = pyodbc.connect(
+        f"DRIVER={driver};SERVER={connstring};PORT=1433;DATABASE={database};",
+        attrs_before={1256: token_struct},
+        timeout=12
+    )
+    conn.timeout = 10
+    return {"conn": conn, "expires_at": expires_at, "last_used": time.time()}
+
+
+def _close_connection(entry):
+    try:
+        entry["conn"].close()
+    except Exception as e:
+        print(f"Connection cleanup failed: {e}")  # best-effort connection cleanup
+
+
+def _is_healthy(entry):
+    """Check a pooled connection before reuse; only connections that sat idle are probed with a round-trip."""
+    if getattr(entry["conn"], "closed", False):
+        return False
+    if entry["expires_at"] - SQL_TOKEN_REFRESH_MARGIN_SECONDS <= time.time():
+        return False
+    if time.time() - entry["last_used"] < SQL_POOL_HEALTH_CHECK_IDLE_SECONDS:
+        return True
+    try:
+        with entry["conn"].cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+def acquire_connection(driver, connstring, database):
+    """Take a healthy connection from the pool, or open a new one when none is available."""
+    key = (driver, connstring, database)
+    while True:
+        with _CONNECTION_POOL_LOCK:
+            idle = _CONNECTION_POOL.get(key)
+            entry = idle.pop() if idle else None
+        if entry is None:
+            return _open_connection(driver, connstring, database)
+        if _is_healthy(entry):
+            return entry
+        _close_connection(entry)
+
+
+def release_connection(driver, connstring, database, entry, discard=False):
+    """Return a connection to the pool. Broken connections (discard=True) and overflow are closed."""
+    if not discard:
+        entry["last_used"] = time.time()
+        with _CONNECTION_POOL_LOCK:
+            idle = _CONNECTION_POOL.setdefault((driver, connstring, database), [])
+            if len(idle) < SQL_POOL_MAX_IDLE_CONNECTIONS:
+                idle.append(entry)
+                return
+    _close_connection(entry)
+
+
+def close_connection_pool():
+    """Close every pooled connection, e.g. at the end of a session."""
+    with _CONNECTION_POOL_LOCK:
+        entries = [entry for idle in _CONNECTION_POOL.values() for entry in idle]
+        _CONNECTION_POOL.clear()
+    for entry in entries:
+        _close_connection(entry)
+
+
+class SqlConnectError(Exception):
+    """The framework database could not be reached; the statement was not sent."""
+
+
+def is_transient_sql_error(error):
+    """True for connection drops, timeouts and throttling that are worth a reconnect and retry."""
+    if not isinstance(error, pyodbc.Error):
+        return False
+    if error.args and str(error.args[0]) in _TRANSIENT_SQLSTATES:
+        return True
+    return any(number in _TRANSIENT_ERROR_NUMBERS for number in re.findall(r"\((\d+)\)", str(error)))
 
 
 # METADATA ********************
@@ -60,41 +207,50 @@ def build_exec_statement(proc_name, **params):
 def execute_with_outputs(exec_statement, driver, connstring, database, **params):
     """
     Runs the given T-SQL (optionally wrapping to capture return code).
+    Connections come from the session pool; opening a connection is retried on
+    transient errors, the statement itself is sent only once.
     Returns a dict with:
       - result_sets: list[list[dict]]
       - return_code: int or None
       - out_params: dict (if you selected them)
       - messages: list[str]
     """
-    # Get token for Azure SQL authentication
-    token = notebookutils.credentials.getToken('https://analysis.windows.net/powerbi/api').encode("UTF-16-LE")
-    token_struct = struct.pack(f'<I{len(token)}s', len(token), token)
-
-    # Build connection
-    conn = pyodbc.connect(
-        f"DRIVER={driver};SERVER={connstring};PORT=1433;DATABASE={database};",
-        attrs_before={1256: token_struct},
-        timeout=12
-    )
     if not exec_statement:
         raise ValueError("proc_name (exec_statement) must not be empty.")
 
     sql_to_run, sql_params = build_exec_statement(exec_statement, **params)
-    use_wrapper = True
+    return run_sql_batch(sql_to_run, sql_params, driver, connstring, database)
+
+
+def _connect_with_retry(driver, connstring, database):
+    """acquire_connection, retried on transient errors: nothing has been sent to the database yet."""
+    for attempt in range(1, SQL_MAX_ATTEMPTS + 1):
+        try:
+            return acquire_connection(driver, connstring, database)
+        except Exception as e:
+            if attempt < SQL_MAX_ATTEMPTS and is_transient_sql_error(e):
+                print(f"Transient SQL error (attempt {attempt}/{SQL_MAX_ATTEMPTS}), reconnecting: {e}")
+                time.sleep(SQL_RETRY_BACKOFF_SECONDS * attempt)
+                continue
+            raise SqlConnectError(f"Framework database {database} not reachable: {e}") from e
+
 
+def run_sql_batch(sql_to_run, sql_params, driver, connstring, database):
+    """Execute a parameterized T-SQL batch on a pooled connection and collect its output (see execute_with_outputs).
 
+    A batch that fails once it was sent is not retried: the stored procedures may already have
+    run. The connection is discarded and the error raised; SqlConnectError means nothing was sent.
+    """
+    use_wrapper = True
     result_sets = []
     messages = []
     return_code = None
     out_params = {}
 
+    entry = _connect_with_retry(driver, connstring, database)
+    conn = entry["conn"]
     try:
         with conn.cursor() as cursor:
-            # Warm-up
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
-            conn.timeout = 10
-
             cursor.execute(sql_to_run, sql_params)
 
             # Collect result sets
@@ -124,32 +280,697 @@ def execute_with_outputs(exec_statement, driver, connstring, database, **params)
                     out_params = {k.replace("__out_", ""): v for k, v in maybe[0].items()}
                     result_sets = result_sets[:-1]
 
-            try:
-                cursor.commit()
+            cursor.commit()
 
-            except Exception as e:
-                print(f"Commit failed (expected for read-only operations): {e}")
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass  # connection may already be gone
+        release_connection(driver, connstring, database, entry, discard=True)
+        raise
 
-            except Exception:
-                pass  # commit may fail on read-only operations
+    release_connection(driver, connstring, database, entry)
+    return {
+        "result_sets": result_sets,
+        "return_code": return_code,
+        "out_params": out_params,
+        "messages": messages
+    }
 
 
-    finally:
+def execute_query(sql, driver, connstring, database, *params):
+    """Run a parameterized SELECT on a pooled connection and return the rows of its first result set as dicts."""
+    result_sets = run_sql_batch(sql, list(params), driver, connstring, database)["result_sets"]
+    return result_sets[0] if result_sets else []
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Buffered metadata writes.
+# Audit and queue updates are collected with queue_sql_call() and sent to the
+# framework database as one multi-statement batch by flush_sql_calls(). The batch
+# runs in a single transaction. When the database cannot be reached nothing is written
+# and the calls stay queued; when a call itself fails, the calls of the batch are written
+# one by one and the failing call is logged and dropped. Each thread has its own buffer,
+# so loads that run side by side in one session (the in-process loader) only flush their
+# own calls. Use exit_notebook() instead of notebookutils.notebook.exit() so the buffer
+# is always flushed; anything still queued when the session ends is flushed as well.
+SQL_BATCH_MAX_PARAMETERS = 2000  # SQL Server accepts at most 2100 parameters per request
+
+if "_SQL_CALL_STATE" not in globals():
+    _SQL_CALL_STATE = threading.local()
+    # Buffers of all threads, for flush_all_sql_calls()
+    _SQL_CALL_BUFFERS = []
+    _SQL_CALL_BUFFER_LOCK = threading.Lock()
+
+
+def _sql_call_buffer():
+    """The buffer of the current thread: {"calls": [(sql, params), ...], "target": {driver, connstring, database}}."""
+    if not hasattr(_SQL_CALL_STATE, "buffer"):
+        _SQL_CALL_STATE.buffer = {"calls": [], "target": {}, "thread": threading.current_thread()}
+        with _SQL_CALL_BUFFER_LOCK:
+            _SQL_CALL_BUFFERS.append(_SQL_CALL_STATE.buffer)
+    return _SQL_CALL_STATE.buffer
+
+
+def queue_sql_call(exec_statement, driver, connstring, database, **params):
+    """Buffer a stored procedure call; it is executed by the next flush_sql_calls() of this thread."""
+    if not exec_statement:
+        raise ValueError("proc_name (exec_statement) must not be empty.")
+
+    sql, sql_params = build_exec_statement(exec_statement, **params)
+    buffer = _sql_call_buffer()
+    with _SQL_CALL_BUFFER_LOCK:
+        buffer["calls"].append((sql, sql_params))
+        buffer["target"].update(driver=driver, connstring=connstring, database=database)
+
+
+# @LogData of sp_AuditNotebook and NotebookExecution.LogData are VARCHAR(8000)
+LOG_DATA_MAX_LENGTH = 8000
+# Parts of result_data dropped, in this order, until the JSON fits in LogData
+LOG_DATA_OPTIONAL_PARTS = [("Instrumentation", "Metrics"), ("DataQuality", "FailedRules"), ("Instrumentation",)]
+
+
+def fit_log_data(result_data, max_length=LOG_DATA_MAX_LENGTH):
+    """Return result_data as JSON that fits in LogData.
+
+    Optional details are dropped one by one and named in "Truncated"; when the JSON is
+    still too long only Action and CopyOutput are kept, cut off at max_length as a last resort.
+    """
+    log_data = json.dumps(result_data, default=str)
+    if len(log_data) <= max_length:
+        return log_data
+    fitted = json.loads(log_data)
+    fitted["Truncated"] = []
+    for path in LOG_DATA_OPTIONAL_PARTS:
+        parent = fitted
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict) or path[-1] not in parent:
+            continue
+        del parent[path[-1]]
+        fitted["Truncated"].append(".".join(path))
+        log_data = json.dumps(fitted, default=str)
+        if len(log_data) <= max_length:
+            return log_data
+    fitted = {key: fitted[key] for key in ("Action", "CopyOutput", "Truncated") if key in fitted}
+    return json.dumps(fitted, default=str)[:max_length]
+
+
+def _split_sql_calls(calls):
+    """Yield (sql, params, call_count) batches that stay below the parameter limit."""
+    position = 0
+    while position < len(calls):
+        statements, batch_params = [], []
+        for sql, sql_params in calls[position:]:
+            if statements and len(batch_params) + len(sql_params) > SQL_BATCH_MAX_PARAMETERS:
+                break
+            statements.append(sql)
+            batch_params.extend(sql_params)
+        yield ";\n".join(statements) + ";", batch_params, len(statements)
+        position += len(statements)
+
+
+def _write_sql_calls(calls, driver, connstring, database):
+    """Write calls in batches. Returns (written, unwritten calls, error); calls are unwritten
+    only when the database could not be reached (SqlConnectError), a call that fails otherwise is dropped."""
+    written = 0
+    position = 0
+    for sql, batch_params, call_count in _split_sql_calls(calls):
+        batch = calls[position:position + call_count]
         try:
-            conn.close()
+            run_sql_batch(sql, batch_params, driver, connstring, database)
+            written += call_count
+        except Exception as e:
+            if isinstance(e, SqlConnectError):
+                return written, calls[position:], e
+            # The batch was rolled back: write its calls one by one to find the one that fails
+            for i, (call_sql, call_params) in enumerate(batch):
+                try:
+                    run_sql_batch(call_sql, call_params, driver, connstring, database)
+                    written += 1
+                except Exception as call_error:
+                    if isinstance(call_error, SqlConnectError):
+                        return written, calls[position + i:], call_error
+                    print(f"SQL call dropped, it failed: {call_sql}: {call_error}")
+        position += call_count
+    return written, [], None
+
+
+def _flush_sql_call_buffer(buffer, driver=None, connstring=None, database=None):
+    with _SQL_CALL_BUFFER_LOCK:
+        calls = list(buffer["calls"])
+        buffer["calls"].clear()
+        driver = driver or buffer["target"].get("driver")
+        connstring = connstring or buffer["target"].get("connstring")
+        database = database or buffer["target"].get("database")
+
+    written, unwritten, error = _write_sql_calls(calls, driver, connstring, database)
+    if unwritten:
+        # Keep what was not written so a later flush can retry it
+        with _SQL_CALL_BUFFER_LOCK:
+            buffer["calls"][:0] = unwritten
+        raise error
+    return written
+
+
+def flush_sql_calls(driver=None, connstring=None, database=None):
+    """Send the calls buffered by this thread in as few round-trips as possible (one, unless the parameter limit is reached).
+    Events still waiting in the asynchronous audit queue are written first, so the log keeps its order.
+
+    Returns:
+        int: number of calls written
+    """
+    drain_async_audit_log()
+    return _flush_sql_call_buffer(_sql_call_buffer(), driver, connstring, database)
 
+
+def flush_all_sql_calls(driver=None, connstring=None, database=None):
+    """Flush the buffers of all threads, e.g. after a thread pool of loads has finished.
+
+    Returns:
+        int: number of calls written
+    """
+    drain_async_audit_log()
+    with _SQL_CALL_BUFFER_LOCK:
+        buffers = list(_SQL_CALL_BUFFERS)
+    written = 0
+    errors = []
+    for buffer in buffers:
+        try:
+            written += _flush_sql_call_buffer(buffer, driver, connstring, database)
         except Exception as e:
-            print(f"Connection cleanup failed: {e}")  # best-effort connection cleanup
+            errors.append(e)
+    with _SQL_CALL_BUFFER_LOCK:
+        # Empty buffers of finished threads are not needed any more
+        _SQL_CALL_BUFFERS[:] = [b for b in _SQL_CALL_BUFFERS if b["calls"] or b["thread"].is_alive()]
+    if errors:
+        raise errors[0]
+    return written
 
-        except Exception:
-            pass  # best-effort connection cleanup
 
+def exit_notebook(result_data, driver=None, connstring=None, database=None):
+    """Stop the asynchronous audit writer, flush the buffered metadata writes, then exit the notebook with result_data."""
+    drain_async_audit_log(stop=True)
+    flush_all_sql_calls(driver, connstring, database)
+    notebookutils.notebook.exit(result_data)
+
+
+def _flush_sql_calls_at_exit():
+    try:
+        flush_all_sql_calls()
+    except Exception as e:
+        print(f"Flushing buffered SQL calls failed: {e}")  # best-effort flush at session end
+
+
+if "_SQL_CALL_FLUSH_REGISTERED" not in globals():
+    atexit.register(_flush_sql_calls_at_exit)
+    _SQL_CALL_FLUSH_REGISTERED = True
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Asynchronous audit logging (opt-in).
+# enable_async_audit_logging() starts a worker thread that writes audit events in the
+# background, so informational calls such as the StartNotebookActivity row no longer
+# block the notebook. The queue is bounded: when it is full the caller waits up to
+# ASYNC_AUDIT_PUT_TIMEOUT_SECONDS and then writes synchronously. Events the worker
+# cannot write stay in its own queue_sql_call buffer and are retried with the next events.
+# exit_notebook() stops the worker and flushes whatever it could not write.
+ASYNC_AUDIT_QUEUE_SIZE = 1000
+ASYNC_AUDIT_PUT_TIMEOUT_SECONDS = 30
+ASYNC_AUDIT_DRAIN_TIMEOUT_SECONDS = 120
+ASYNC_AUDIT_MAX_EVENTS_PER_BATCH = 50
+
+# Queued by drain_async_audit_log(stop=True): the worker writes what it has and ends
+_ASYNC_AUDIT_STOP = None
+
+if "_ASYNC_AUDIT_QUEUE" not in globals():
+    _ASYNC_AUDIT_QUEUE = None
+    _ASYNC_AUDIT_WORKER = None
+
+
+def _async_audit_worker(audit_queue, driver, connstring, database):
+    # Events are written through the buffer of this thread, so a failed write is retried
+    # with the next events and never lands in the buffer of a load
+    buffer = _sql_call_buffer()
+    while True:
+        calls = [audit_queue.get()]
+        while len(calls) < ASYNC_AUDIT_MAX_EVENTS_PER_BATCH:
+            try:
+                calls.append(audit_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = _ASYNC_AUDIT_STOP in calls
+        events = [call for call in calls if call is not _ASYNC_AUDIT_STOP]
+        with _SQL_CALL_BUFFER_LOCK:
+            buffer["calls"].extend(events)
+            buffer["target"].update(driver=driver, connstring=connstring, database=database)
+        try:
+            _flush_sql_call_buffer(buffer)
+        except Exception as e:
+            print(f"Asynchronous audit logging failed, events are retried with the next ones: {e}")
+        finally:
+            for _ in calls:
+                audit_queue.task_done()
+        if stop:
+            return
+
+
+def enable_async_audit_logging(driver, connstring, database, max_queue_size=ASYNC_AUDIT_QUEUE_SIZE):
+    """Start the background audit writer; execute_audit_call() then returns without waiting on the database.
+
+    Events the writer has not written yet are written by exit_notebook(), which stops the writer first.
+    """
+    global _ASYNC_AUDIT_QUEUE, _ASYNC_AUDIT_WORKER
+    if _ASYNC_AUDIT_WORKER is not None and _ASYNC_AUDIT_WORKER.is_alive():
+        return
+
+    _ASYNC_AUDIT_QUEUE = queue.Queue(maxsize=max_queue_size)
+    _ASYNC_AUDIT_WORKER = threading.Thread(
+        target=_async_audit_worker,
+        args=(_ASYNC_AUDIT_QUEUE, driver, connstring, database),
+        name="fmd-async-audit",
+        daemon=True
+    )
+    _ASYNC_AUDIT_WORKER.start()
+
+
+def execute_audit_call(exec_statement, driver, connstring, database, **params):
+    """Write an audit event: enqueued when asynchronous logging is enabled, otherwise executed directly."""
+    if _ASYNC_AUDIT_WORKER is None or not _ASYNC_AUDIT_WORKER.is_alive():
+        return execute_with_outputs(exec_statement, driver, connstring, database, **params)
+
+    if not exec_statement:
+        raise ValueError("proc_name (exec_statement) must not be empty.")
+    try:
+        _ASYNC_AUDIT_QUEUE.put(build_exec_statement(exec_statement, **params), timeout=ASYNC_AUDIT_PUT_TIMEOUT_SECONDS)
+    except queue.Full:
+        print("Asynchronous audit queue is full, writing synchronously")
+        return execute_with_outputs(exec_statement, driver, connstring, database, **params)
+
+
+def drain_async_audit_log(timeout=ASYNC_AUDIT_DRAIN_TIMEOUT_SECONDS, stop=False):
+    """Wait until the background writer has written every queued event (no-op when it is not running).
+    With stop=True the writer ends afterwards; later audit events are written synchronously.
+
+    Returns:
+        bool: True when the queue is empty
+    """
+    audit_queue = _ASYNC_AUDIT_QUEUE
+    worker = _ASYNC_AUDIT_WORKER
+    if audit_queue is None or worker is None or not worker.is_alive():
+        return True
+
+    deadline = time.time() + timeout
+    if stop:
+        try:
+            audit_queue.put(_ASYNC_AUDIT_STOP, timeout=timeout)
+        except queue.Full:
+            print(f"Asynchronous audit queue still full after {timeout}s, writer not stopped")
+    with audit_queue.all_tasks_done:
+        while audit_queue.unfinished_tasks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print(f"Asynchronous audit queue not drained within {timeout}s, {audit_queue.unfinished_tasks} event(s) pending")
+                return False
+            audit_queue.all_tasks_done.wait(remaining)
+    if stop:
+        worker.join(max(0, deadline - time.time()))
+    return True
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Schema registry for delimited landing files.
+# The schema of an entity is learned on its first load and stored as a JSON sidecar in
+# the landing zone lakehouse (Files/_fmd_schema_registry/<LandingzoneEntityId>.json).
+# Later loads pass it to the reader as an explicit StructType, which skips the
+# inference pass and keeps the column types stable from file to file.
+SCHEMA_REGISTRY_FOLDER = "_fmd_schema_registry"
+SCHEMA_REGISTRY_MAX_BYTES = 10 * 1024 * 1024
+
+from pyspark.sql.types import StructType
+
+
+def schema_registry_path(workspace, lakehouse, entity_id):
+    return f"abfss://{workspace}@onelake.dfs.fabric.microsoft.com/{lakehouse}/Files/{SCHEMA_REGISTRY_FOLDER}/{entity_id}.json"
+
+
+def load_registered_schema(path):
+    """Return the registered StructType, or None when the entity has no registered schema yet."""
+    if not notebookutils.fs.exists(path):
+        return None
+    entry = json.loads(notebookutils.fs.head(path, SCHEMA_REGISTRY_MAX_BYTES))
+    return StructType.fromJson(entry["Schema"])
+
+
+def save_registered_schema(path, schema, entity_id):
+    entry = {
+        "EntityId": entity_id,
+        "Columns": schema.fieldNames(),
+        "Schema": schema.jsonValue(),
+        "RegisteredAt": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    }
+    notebookutils.fs.put(path, json.dumps(entry), True)
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Excel ingestion.
+# Workbooks are streamed row by row (openpyxl read-only mode for xlsx, xlrd for xls)
+# and written in Arrow record batches of EXCEL_CHUNK_ROWS rows to a Parquet file in a
+# staging folder, which Spark then reads in parallel. The driver only ever holds one
+# chunk, so large sheets no longer have to fit in a pandas DataFrame.
+EXCEL_CHUNK_ROWS = 50000
+
+import datetime as _dt
+import os, shutil, tempfile
+
+
+def _excel_sheet_names(local_path, file_type):
+    if file_type == "xls":
+        import xlrd
+        book = xlrd.open_workbook(local_path, on_demand=True)
+        names = book.sheet_names()
+        book.release_resources()
+        return names
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(local_path, read_only=True)
+    names = workbook.sheetnames
+    workbook.close()
+    return names
+
+
+def _excel_rows(local_path, file_type, sheet_name):
+    """Yield the rows of one sheet as tuples of Python values."""
+    if file_type == "xls":
+        import xlrd
+        book = xlrd.open_workbook(local_path, on_demand=True)
+        try:
+            sheet = book.sheet_by_name(sheet_name)
+            for r in range(sheet.nrows):
+                values = []
+                for cell in sheet.row(r):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        values.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                    elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                        values.append(bool(cell.value))
+                    elif cell.ctype == xlrd.XL_CELL_NUMBER and float(cell.value).is_integer():
+                        values.append(int(cell.value))
+                    elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+                        values.append(None)
+                    else:
+                        values.append(cell.value)
+                yield tuple(values)
+        finally:
+            book.release_resources()
+        return
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(local_path, read_only=True, data_only=True)
+    try:
+        yield from workbook[sheet_name].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _excel_column_names(header):
+    """Column names as pandas.read_excel would produce them."""
+    names = []
+    for i, value in enumerate(header):
+        name = str(value) if value is not None else f"Unnamed: {i}"
+        base, n = name, 1
+        while name in names:
+            name = f"{base}.{n}"
+            n += 1
+        names.append(name)
+    return names
+
+
+def _arrow_type(kinds):
+    import pyarrow as pa
+    if not kinds:
+        return pa.string()
+    if kinds == {bool}:
+        return pa.bool_()
+    if kinds == {int}:
+        return pa.int64()
+    if kinds <= {int, float}:
+        return pa.float64()
+    if kinds == {_dt.datetime}:
+        return pa.timestamp("us")
+    if kinds == {_dt.date}:
+        return pa.date32()
+    return pa.string()
+
+
+def _stage_excel_sheet(local_path, file_type, sheet_name, local_parquet, chunk_size):
+    """Write one sheet to a local Parquet file. A first pass over the sheet fixes one Arrow type per column."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = _excel_rows(local_path, file_type, sheet_name)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError(f"Sheet '{sheet_name}' is empty.")
+    columns = _excel_column_names(header)
+    width = len(columns)
+
+    kinds = [set() for _ in range(width)]
+    for row in rows:
+        for i, value in enumerate(row[:width]):
+            if value is not None:
+                kinds[i].add(type(value))
+    schema = pa.schema([(name, _arrow_type(k)) for name, k in zip(columns, kinds)])
+
+    def to_batch(chunk):
+        arrays = []
+        for field, values in zip(schema, zip(*chunk)):
+            if field.type == pa.string():
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    row_count = 0
+    with pq.ParquetWriter(local_parquet, schema) as writer:
+        chunk = []
+        rows = _excel_rows(local_path, file_type, sheet_name)
+        next(rows)  # header
+        for row in rows:
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            if all(v is None for v in row):
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                writer.write_batch(to_batch(chunk))
+                row_count += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write_batch(to_batch(chunk))
+            row_count += len(chunk)
+        if row_count == 0:
+            writer.write_table(schema.empty_table())
+    return row_count
+
+
+def read_excel_to_spark(source_path, file_type, staging_path, sheet_name="", chunk_size=EXCEL_CHUNK_ROWS):
+    """Load an xlsx/xls file into a Spark DataFrame through a Parquet staging folder.
+
+    sheet_name: '' for the first sheet, '*' for all sheets, or a ',' / ';' separated list.
+    When more than one sheet is read the result gets a SheetName column.
+    The DataFrame reads from staging_path; the caller removes it once the data has been written.
+    """
+    local_dir = tempfile.mkdtemp(prefix="fmd_excel_")
+    try:
+        local_file = os.path.join(local_dir, f"source.{file_type}")
+        notebookutils.fs.cp(source_path, f"file:{local_file}")
+
+        available = _excel_sheet_names(local_file, file_type)
+        if not sheet_name:
+            sheets = available[:1]
+        elif str(sheet_name).strip() == "*":
+            sheets = available
+        else:
+            sheets = [name.strip() for name in re.split("[,;]", str(sheet_name)) if name.strip()]
+            missing = [name for name in sheets if name not in available]
+            if missing:
+                raise ValueError(f"Sheet(s) {missing} not found. Available sheets: {available}")
+
+        if notebookutils.fs.exists(staging_path):
+            notebookutils.fs.rm(staging_path, True)
+
+        frames = []
+        for i, sheet in enumerate(sheets):
+            local_parquet = os.path.join(local_dir, f"sheet_{i}.parquet")
+            row_count = _stage_excel_sheet(local_file, file_type, sheet, local_parquet, chunk_size)
+            print(f"Sheet '{sheet}': {row_count} rows staged")
+            notebookutils.fs.cp(f"file:{local_parquet}", f"{staging_path}/sheet_{i}.parquet")
+            frames.append((sheet, spark.read.parquet(f"{staging_path}/sheet_{i}.parquet")))
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    if len(frames) == 1:
+        return frames[0][1]
+
+    from pyspark.sql.functions import lit
+    df = None
+    for sheet, frame in frames:
+        frame = frame.withColumn("SheetName", lit(sheet))
+        df = frame if df is None else df.unionByName(frame, allowMissingColumns=True)
+    return df
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Stage timing and load metrics.
+# Load notebooks call start_stage() at the start of each phase (read, cleansing, DQ, hash,
+# merge, logging); the running stage ends when the next one starts. Stages measure wall-clock
+# time on the driver, so a lazy transformation is paid for in the stage that runs its action.
+# get_instrumentation() returns the timings and metrics for result_data["Instrumentation"].
+# The state is kept per thread, so loads that run side by side in one session (the
+# in-process loader) each report their own numbers; reset_instrumentation() starts over.
+from contextlib import contextmanager
+
+_INSTRUMENTATION_STATE = threading.local()
+
+
+def reset_instrumentation():
+    """Clear the stage timings and metrics of the current thread."""
+    _INSTRUMENTATION_STATE.timings = {}
+    _INSTRUMENTATION_STATE.metrics = {}
+    _INSTRUMENTATION_STATE.stage = None
+    _INSTRUMENTATION_STATE.started = None
+
+
+def _instrumentation():
+    if not hasattr(_INSTRUMENTATION_STATE, "timings"):
+        reset_instrumentation()
+    return _INSTRUMENTATION_STATE
 
+
+def start_stage(name):
+    """End the running stage, if any, and start timing the named stage."""
+    end_stage()
+    state = _instrumentation()
+    state.stage = name
+    state.started = time.perf_counter()
+
+
+def end_stage():
+    """End the running stage and add its duration to the stage totals."""
+    state = _instrumentation()
+    if state.stage is None:
+        return
+    elapsed = time.perf_counter() - state.started
+    state.timings[state.stage] = state.timings.get(state.stage, 0.0) + elapsed
+    state.stage = None
+    state.started = None
+
+
+@contextmanager
+def stage_timer(name):
+    """Time a block as the named stage."""
+    start_stage(name)
+    try:
+        yield
+    finally:
+        end_stage()
+
+
+def record_metric(name, value):
+    _instrumentation().metrics[name] = value
+
+
+def get_delta_operation_metrics(table_path, operations=None, history_depth=1):
+    """Return operation, version and operationMetrics of the latest matching commit of a Delta table.
+
+    operations limits the search to these operation names (e.g. ("MERGE", "WRITE")) within the
+    last history_depth commits. Returns an empty dict when no commit matches.
+    """
+    from delta.tables import DeltaTable
+
+    history = DeltaTable.forPath(spark, table_path).history(history_depth).select("version", "operation", "operationMetrics").collect()
+    for commit in history:
+        if operations is None or commit["operation"] in operations:
+            metrics = {key: int(value) if str(value).isdigit() else value for key, value in (commit["operationMetrics"] or {}).items()}
+            return {"Operation": commit["operation"], "Version": commit["version"], **metrics}
+    return {}
+
+
+# operationMetrics keys summed into the merge metrics; appends (WRITE) report rows and
+# files under their own names and are mapped onto the merge ones.
+MERGE_METRIC_KEYS = ("numTargetRowsInserted", "numTargetRowsUpdated", "numTargetRowsDeleted",
+                     "numTargetFilesAdded", "numTargetFilesRemoved", "executionTimeMs", "scanTimeMs", "rewriteTimeMs")
+_WRITE_METRIC_KEYS = {"numOutputRows": "numTargetRowsInserted", "numFiles": "numTargetFilesAdded"}
+
+
+def get_merge_metrics(table_path, since_version=None, history_depth=10):
+    """Sum the merge metrics of the MERGE and WRITE commits after since_version.
+
+    The rows and files written by one load show its write amplification; the loads report them in result_data.
+
+    Searching history_depth commits skips the OPTIMIZE commits that auto compaction adds after a merge.
+    """
+    from delta.tables import DeltaTable
+
+    merge_metrics = {key: 0 for key in MERGE_METRIC_KEYS}
+    merge_metrics["Commits"] = 0
+    history = DeltaTable.forPath(spark, table_path).history(history_depth).select("version", "operation", "operationMetrics").collect()
+    for commit in history:
+        if since_version is not None and commit["version"] <= since_version:
+            break
+        if commit["operation"] not in ("MERGE", "WRITE"):
+            continue
+        metrics = commit["operationMetrics"] or {}
+        for key, value in metrics.items():
+            key = _WRITE_METRIC_KEYS.get(key, key) if commit["operation"] == "WRITE" else key
+            if key in merge_metrics and str(value).isdigit():
+                merge_metrics[key] += int(value)
+        merge_metrics["Commits"] += 1
+    return merge_metrics
+
+
+def get_instrumentation():
+    """Return stage timings (seconds) and recorded metrics as a JSON-serializable dict."""
+    end_stage()
+    state = _instrumentation()
     return {
-        "result_sets": result_sets,
-        "return_code": return_code,
-        "out_params": out_params,
-        "messages": messages
+        "Stages": {name: round(seconds, 3) for name, seconds in state.timings.items()},
+        "Metrics": dict(state.metrics)
     }
 
 # METADATA ********************
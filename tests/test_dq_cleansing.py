@@ -0,0 +1,52 @@
+"""Tests for the cleansing functions of NB_FMD_DQ_CLEANSING, run against a local SparkSession."""
+import re
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pyspark = pytest.importorskip("pyspark")
+
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.types import StringType, StructField, StructType
+
+NOTEBOOK = Path(__file__).resolve().parents[1] / "src" / "NB_FMD_DQ_CLEANSING.Notebook" / "notebook-content.py"
+
+
+@pytest.fixture(scope="module")
+def spark():
+    session = SparkSession.builder.master("local[1]").appName("fmd-dq-cleansing-tests").getOrCreate()
+    yield session
+    session.stop()
+
+
+@pytest.fixture()
+def cleansing(spark):
+    """Namespace of the notebook, without its %run cells."""
+    source = re.sub(r"^%run .*$", "", NOTEBOOK.read_text(encoding="utf-8"), flags=re.MULTILINE)
+    namespace = {"spark": spark, "DataFrame": DataFrame}
+    exec(compile(source, str(NOTEBOOK), "exec"), namespace)
+    return namespace
+
+
+def test_vectorized_function_with_ddl_return_type_then_fill_nulls(spark, cleansing):
+    cleansing["register_vectorized_cleansing_function"](
+        "upper_text", lambda series: series.str.upper(), return_type="string")
+    df = spark.createDataFrame([("a",), (None,)], StructType([StructField("Name", StringType())]))
+
+    rules = [
+        {"function": "upper_text", "columns": "Name"},
+        {"function": "fill_nulls", "columns": "Name", "parameters": {"default_string": "N/A"}},
+    ]
+    result = cleansing["handle_cleansing_functions"](df, rules)
+
+    assert result.schema["Name"].dataType == StringType()
+    assert sorted(row["Name"] for row in result.collect()) == ["A", "N/A"]
+
+
+def test_rule_on_unknown_column_fails(spark, cleansing):
+    df = spark.createDataFrame([("a",)], StructType([StructField("Name", StringType())]))
+
+    with pytest.raises(ValueError, match="Nmae"):
+        cleansing["handle_cleansing_functions"](df, [{"function": "normalize_text", "columns": "Nmae"}])